@@ -4,7 +4,7 @@ from datetime import datetime, timedelta
 import ecdsa
 from ecdsa.keys import BadSignatureError
 from email_validator import validate_email, EmailNotValidError
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, make_response, request
 from hashlib import sha256
 from io import BytesIO
 import json
@@ -21,14 +21,39 @@ import time
 from extensions import db
 import models as m
 from main import app, get_birdwatcher, get_lndhub_client, get_file_storage, get_mail
+from main import NostrQueryError, query_metadata_cached, query_skin_in_the_game_cached
 from main import get_token_from_request, get_user_from_token, user_required, nip98_auth_required
-from main import MempoolSpaceError
+from main import MempoolSpaceError, response_cache
 from nostr_utils import EventValidationError, validate_event
 from utils import usd2sats, sats2usd, parse_github_tag, parse_xpub, UnknownKeyTypeError
 
 api_blueprint = Blueprint('api', __name__)
 
 
+def cached_response(build, collections, for_user_id=None, cls=None, refresh=None):
+    """
+    Respond with the payload returned by `build`, using the response cache and ETags.
+
+    The ETag is derived from the versions of the `collections` the payload depends on (and from the next time-based transition of `cls`),
+    so a matching If-None-Match gets a 304 without building anything.
+    Payloads containing fields relative to the current time need a `refresh` function, which is applied even to cached payloads.
+    These get a weak ETag, which changes every ETAG_TIME_BUCKET_SECONDS.
+    """
+    key = (request.path, tuple(sorted(request.args.items(multi=True))), for_user_id)
+    version = (m.State.get_versions(collections), cls.get_next_transition() if cls else None)
+
+    etag = sha256(repr((key, version)).encode('utf-8')).hexdigest()
+    if refresh:
+        etag += f"-{int(time.time()) // app.config['ETAG_TIME_BUCKET_SECONDS']}"
+
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        payload = response_cache.get_or_build(key, version, build)
+        response = make_response(jsonify(refresh(payload) if refresh else payload))
+    response.set_etag(etag, weak=bool(refresh))
+    return response
+
 def get_last_github_release_version():
     endpoint = f"https://api.github.com/repos/{app.config['GITHUB_OWNER']}/{app.config['GITHUB_REPO']}/releases"
     github_versions = [parse_github_tag(r['tag_name']) for r in requests.get(endpoint).json()]
@@ -421,6 +446,8 @@ def migrate_user(user):
     if not get_birdwatcher().publish_badge_award(app.config['BADGE_DEFINITION_OG']['badge_id'], user.nostr_public_key):
         app.logger.warning(f"Failed to publish badge award for {user.nostr_public_key}")
 
+    db.session.commit()
+
     return jsonify({})
 
 # request made by the Lightning wallet, includes a key and a signature
@@ -596,10 +623,16 @@ def get_entities(cls, plural):
     """
     Active auctions are all auctions currently running.
     Active listings are all listings that have been published and are still available for sale.
+    Pass `limit` (and then the returned `next_cursor` as `cursor`) to paginate. See CatalogMixin.query_page for sorting and filtering.
     """
-    entities = cls.query_all_active()
-    sorted_entities = sorted(entities.all(), key=cls.sort_key)
-    return jsonify({plural: [e.to_dict() for e in sorted_entities]})
+    def build():
+        entities, next_cursor = cls.query_page(cls.query_all_active().options(*cls.get_eager_load_options()), request.args)
+        return {plural: cls.to_dicts(entities), 'next_cursor': next_cursor}
+
+    try:
+        return cached_response(build, [plural], cls=cls, refresh=cls.get_payload_refresh(plural))
+    except m.ValidationError as e:
+        return jsonify({'message': e.message}), 400
 
 @api_blueprint.route('/api/auctions/inactive',
     defaults={'cls': m.Auction, 'plural': 'auctions'},
@@ -612,9 +645,14 @@ def get_inactive_entities(cls, plural):
     Inactive auctions are auctions that ended.
     Inactive listings are listings that used to be active, but available_quantity reached 0.
     """
-    entities = cls.query_all_inactive()
-    sorted_entities = sorted(entities.all(), key=cls.sort_key)
-    return jsonify({plural: [e.to_dict() for e in sorted_entities]})
+    def build():
+        entities, next_cursor = cls.query_page(cls.query_all_inactive().options(*cls.get_eager_load_options()), request.args)
+        return {plural: cls.to_dicts(entities), 'next_cursor': next_cursor}
+
+    try:
+        return cached_response(build, [plural], cls=cls)
+    except m.ValidationError as e:
+        return jsonify({'message': e.message}), 400
 
 @api_blueprint.route('/api/auctions/<key>',
     defaults={'cls': m.Auction, 'singular': 'auction'},
@@ -809,12 +847,12 @@ def put_publish(user, key, cls, start):
     return jsonify({})
 
 @api_blueprint.route("/api/users/<nym>/auctions",
-    defaults={'plural': 'auctions'},
+    defaults={'cls': m.Auction, 'plural': 'auctions'},
     methods=['GET'])
 @api_blueprint.route("/api/users/<nym>/listings",
-    defaults={'plural': 'listings'},
+    defaults={'cls': m.Listing, 'plural': 'listings'},
     methods=['GET'])
-def get_user_entities(nym, plural):
+def get_user_entities(nym, cls, plural):
     for_user = get_user_from_token(get_token_from_request())
     for_user_id = for_user.id if for_user else None
     user = for_user if nym == 'me' else m.User.query.filter_by(nym=nym).first()
@@ -827,14 +865,17 @@ def get_user_entities(nym, plural):
             for entity in getattr(item, plural):
                 yield entity
 
-    entities = {}
-    for entity in iter_entities():
-        if entity.filter_state(request.args.get('filter'), for_user_id):
-            entities[f"{plural}_{entity.id}"] = entity
+    def build():
+        entities = {}
+        for entity in iter_entities():
+            if entity.filter_state(request.args.get('filter'), for_user_id):
+                entities[f"{plural}_{entity.id}"] = entity
+
+        sorted_entities = sorted(entities.values(), key=lambda l: l.created_at, reverse=True)
 
-    sorted_entities = sorted(entities.values(), key=lambda l: l.created_at, reverse=True)
+        return {plural: [e.to_dict(for_user=for_user_id) for e in sorted_entities]}
 
-    return jsonify({plural: [e.to_dict(for_user=for_user_id) for e in sorted_entities]})
+    return cached_response(build, [plural], for_user_id=for_user_id, cls=cls, refresh=cls.get_payload_refresh(plural))
 
 @api_blueprint.route("/api/users/<nostr_pubkey>/stalls", methods=['GET'])
 def get_user_stalls(nostr_pubkey):
@@ -854,7 +895,10 @@ def get_relays():
 
 @api_blueprint.route("/api/badges", methods=['GET'])
 def get_badges():
-    return [b.to_dict() for b in m.Badge.query.all()]
+    def build():
+        return [b.to_dict() for b in m.Badge.query.all()]
+
+    return cached_response(build, ['badges'])
 
 @api_blueprint.route("/api/badges/configure-default", methods=['PUT'])
 def configure_default_badges():
@@ -869,17 +913,13 @@ def configure_default_badges():
 
 @api_blueprint.route("/api/keys/<pubkey>/metadata", methods=['GET'])
 def query_metadata(pubkey):
-    birdwatcher = get_birdwatcher()
-
-    metadata = birdwatcher.query_metadata(pubkey)
-
-    badge = m.Badge.query.filter_by(badge_id=app.config['SKIN_IN_THE_GAME_BADGE_ID']).first()
-    awards = birdwatcher.query_badge_award(badge.owner_public_key, pubkey)
-    awards['has_skin_in_the_game'] = badge.badge_id in awards['awarded_badges']
-
-    metadata.update(awards)
+    try:
+        metadata = query_metadata_cached(pubkey)
+        badge, awards = query_skin_in_the_game_cached(pubkey)
+    except NostrQueryError as e:
+        return jsonify({'message': str(e)}), 503
 
-    return jsonify(metadata)
+    return jsonify({**metadata, **awards, 'has_skin_in_the_game': badge['badge_id'] in awards['awarded_badges']})
 
 @api_blueprint.route("/api/merchants/<pubkey>", methods=['GET'])
 def get_merchant(pubkey):
@@ -892,17 +932,23 @@ def get_merchant(pubkey):
 
 @api_blueprint.route("/api/merchants", methods=['GET'])
 def get_merchants():
-    sellers = []
-    for user in m.User.query.all():
-        if user.merchant_public_key:
-            # NB: a merchant can currently only have one stall, but this will change
-            sellers.append({'public_key': user.merchant_public_key, 'stalls': [{'name': user.stall_name, 'description': user.stall_description}]})
-    return jsonify(sellers)
+    def build():
+        sellers = []
+        for user in m.User.query.all():
+            if user.merchant_public_key:
+                # NB: a merchant can currently only have one stall, but this will change
+                sellers.append({'public_key': user.merchant_public_key, 'stalls': [{'name': user.stall_name, 'description': user.stall_description}]})
+        return sellers
+
+    return cached_response(build, ['merchants'])
 
 @api_blueprint.route("/api/merchants/<pubkey>/messages", methods=['POST'])
 def post_merchant_message(pubkey):
+    return process_merchant_message(pubkey, request.json)
+
+def process_merchant_message(pubkey, event):
     try:
-        validate_event(request.json)
+        validate_event(event)
     except EventValidationError as e:
         return jsonify({'message': e.message}), 400
 
@@ -910,16 +956,20 @@ def post_merchant_message(pubkey):
     if not merchant:
         return jsonify({'message': "Merchant not found!"}), 404
 
+    if m.ProcessedEvent.is_processed(event['id']):
+        return jsonify({'message': "Message already processed!"}), 409
+    m.ProcessedEvent.mark(event['id'])
+
     merchant_private_key = merchant.parse_merchant_private_key()
 
-    if request.json['kind'] != 4:
+    if event['kind'] != 4:
         # this should not happen as the birdwatcher already filters DMs
         app.logger.warning("Received a non-DM as a merchant message. Ignoring.")
         return jsonify({})
 
     cleartext_content = None
     try:
-        cleartext_content = json.loads(merchant_private_key.decrypt_message(request.json['content'], public_key_hex=request.json['pubkey']))
+        cleartext_content = json.loads(merchant_private_key.decrypt_message(event['content'], public_key_hex=event['pubkey']))
     except json.decoder.JSONDecodeError:
         app.logger.info("DM content is not JSON. Ignoring.")
         return jsonify({})
@@ -943,18 +993,20 @@ def post_merchant_message(pubkey):
 
     if 'id' not in cleartext_content:
         message = "Invalid order: missing id."
-        birdwatcher.send_dm(merchant_private_key, request.json['pubkey'], message)
+        birdwatcher.send_dm(merchant_private_key, event['pubkey'], message)
+        db.session.commit()
         return jsonify({'message': message}), 400
 
     if 'shipping_id' not in cleartext_content:
         message = "Invalid order: missing shipping zone."
-        birdwatcher.send_dm(merchant_private_key, request.json['pubkey'],
+        birdwatcher.send_dm(merchant_private_key, event['pubkey'],
             json.dumps({'id': cleartext_content['id'], 'type': 2, 'paid': False, 'shipped': False, 'message': message}))
+        db.session.commit()
         return jsonify({'message': message}), 400
 
     order = m.Order.query.filter_by(uuid=cleartext_content['id']).one_or_none()
 
-    if order and order.buyer_public_key != request.json['pubkey']:
+    if order and order.buyer_public_key != event['pubkey']:
         return jsonify({'message': "Not allowed!"}), 403
 
     if order and (order.paid_at or order.shipped_at or order.expired_at or order.canceled_at):
@@ -975,8 +1027,9 @@ def post_merchant_message(pubkey):
         shipping_usd = merchant.shipping_domestic_usd
     else:
         message = "Invalid shipping zone!"
-        birdwatcher.send_dm(merchant_private_key, request.json['pubkey'],
+        birdwatcher.send_dm(merchant_private_key, event['pubkey'],
             json.dumps({'id': cleartext_content['id'], 'type': 2, 'paid': False, 'shipped': False, 'message': message}))
+        db.session.commit()
         return jsonify({'message': message}), 400
 
     if not order:
@@ -998,27 +1051,30 @@ def post_merchant_message(pubkey):
             if listing:
                 if not listing.nostr_event_id:
                     message = "Listing not active."
-                    birdwatcher.send_dm(merchant_private_key, request.json['pubkey'],
+                    birdwatcher.send_dm(merchant_private_key, event['pubkey'],
                         json.dumps({'id': cleartext_content['id'], 'type': 2, 'paid': False, 'shipped': False, 'message': message}))
+                    db.session.commit()
                     return jsonify({'message': message}), 403
                 if listing.available_quantity is not None and listing.available_quantity < item['quantity']:
                     message = "Not enough items in stock!"
-                    birdwatcher.send_dm(merchant_private_key, request.json['pubkey'],
+                    birdwatcher.send_dm(merchant_private_key, event['pubkey'],
                         json.dumps({'id': cleartext_content['id'], 'type': 2, 'paid': False, 'shipped': False, 'message': message}))
+                    db.session.commit()
                     return jsonify({'message': message}), 400
                 order_listings.append((listing, item['quantity']))
 
         if len(order_listings) == 0:
             message = "Empty order!"
-            birdwatcher.send_dm(merchant_private_key, request.json['pubkey'],
+            birdwatcher.send_dm(merchant_private_key, event['pubkey'],
                 json.dumps({'id': cleartext_content['id'], 'type': 2, 'paid': False, 'shipped': False, 'message': message}))
+            db.session.commit()
             return jsonify({'message': message}), 400
 
         order = m.Order(
             uuid=cleartext_content['id'],
             seller_id=merchant.id,
-            event_id=request.json['id'],
-            buyer_public_key=request.json['pubkey'],
+            event_id=event['id'],
+            buyer_public_key=event['pubkey'],
             buyer_name=cleartext_content.get('name'),
             buyer_address=cleartext_content.get('address'),
             buyer_message=cleartext_content.get('message'),
@@ -1139,8 +1195,11 @@ def post_merchant_message(pubkey):
 
 @api_blueprint.route("/api/merchants/<merchant_pubkey>/auctions/<auction_event_id>/bids", methods=['POST'])
 def post_auction_bid(merchant_pubkey, auction_event_id):
+    return process_auction_bid(merchant_pubkey, auction_event_id, request.json)
+
+def process_auction_bid(merchant_pubkey, auction_event_id, event):
     try:
-        validate_event(request.json)
+        validate_event(event)
     except EventValidationError as e:
         return jsonify({'message': e.message}), 400
 
@@ -1152,78 +1211,137 @@ def post_auction_bid(merchant_pubkey, auction_event_id):
     if not auction:
         return jsonify({'message': "Auction not found!"}), 404
 
+    if m.ProcessedEvent.is_processed(event['id']):
+        return jsonify({'message': "Bid already processed!"}), 409
+    m.ProcessedEvent.mark(event['id'])
+
     birdwatcher = get_birdwatcher()
 
-    if request.json['pubkey'] == merchant_pubkey or request.json['pubkey'] == merchant.nostr_public_key:
+    if event['pubkey'] == merchant_pubkey or event['pubkey'] == merchant.nostr_public_key:
         message = "Cannot bid on one's own auction!"
-        birdwatcher.publish_bid_status(auction, request.json['id'], 'rejected', message)
+        birdwatcher.publish_bid_status(auction, event['id'], 'rejected', message)
+        db.session.commit() # NB: we still need to commit, so the bid status (which was added to the outbox) gets published
         return jsonify({'message': message}), 400
 
     try:
-        amount = int(request.json['content'])
+        amount = int(event['content'])
     except TypeError:
         message = "Invalid bid amount!"
-        birdwatcher.publish_bid_status(auction, request.json['id'], 'rejected', message)
+        birdwatcher.publish_bid_status(auction, event['id'], 'rejected', message)
+        db.session.commit()
         return jsonify({'message': message}), 400
 
     if not auction.started:
         message = "Auction not started."
-        birdwatcher.publish_bid_status(auction, request.json['id'], 'rejected', message)
+        birdwatcher.publish_bid_status(auction, event['id'], 'rejected', message)
+        db.session.commit()
         return jsonify({'message': message}), 400
     if auction.ended:
         message = "Auction ended."
-        birdwatcher.publish_bid_status(auction, request.json['id'], 'rejected', message)
+        birdwatcher.publish_bid_status(auction, event['id'], 'rejected', message)
+        db.session.commit()
         return jsonify({'message': message}), 400
 
     if amount > 2100000000:
         message = "Max bidding: 21 BTC!"
-        birdwatcher.publish_bid_status(auction, request.json['id'], 'rejected', message)
+        birdwatcher.publish_bid_status(auction, event['id'], 'rejected', message)
+        db.session.commit()
         return jsonify({'message': message}), 400
 
     top_bid = auction.get_top_bid()
 
     if top_bid and amount <= top_bid.amount:
         message = f"Amount needs to be higher than the previous top bid!"
-        birdwatcher.publish_bid_status(auction, request.json['id'], 'rejected', message)
+        birdwatcher.publish_bid_status(auction, event['id'], 'rejected', message)
+        db.session.commit()
         return jsonify({'message': message}), 400
     elif amount < auction.starting_bid:
         message = f"Amount needs to be at least {auction.starting_bid}, the starting bid."
-        birdwatcher.publish_bid_status(auction, request.json['id'], 'rejected', message)
+        birdwatcher.publish_bid_status(auction, event['id'], 'rejected', message)
+        db.session.commit()
         return jsonify({'message': message}), 400
 
     is_settled = True
     if amount > auction.reserve_bid:
+        try:
+            buyer_metadata = query_metadata_cached(event['pubkey']) if auction.verified_identities_required > 0 else None
+            badge, buyer_awards = query_skin_in_the_game_cached(event['pubkey']) if auction.skin_in_the_game_required else (None, None)
+        except NostrQueryError as e:
+            # NB: we can't tell whether the bidder qualifies, so we don't decide anything yet (nothing was committed), but let birdwatcher retry
+            return jsonify({'message': str(e)}), 503
+
         if auction.verified_identities_required > 0:
-            buyer_metadata = birdwatcher.query_metadata(request.json['pubkey'])
             if len(buyer_metadata['verified_identities']) < auction.verified_identities_required:
                 message = f"User needs at least {auction.verified_identities_required} verified external identities in order to bid!"
-                app.logger.info(f"{message} pubkey={request.json['pubkey']} verified_identities={buyer_metadata['verified_identities']}")
-                birdwatcher.publish_bid_status(auction, request.json['id'], 'rejected', message)
+                app.logger.info(f"{message} pubkey={event['pubkey']} verified_identities={buyer_metadata['verified_identities']}")
+                birdwatcher.publish_bid_status(auction, event['id'], 'rejected', message)
                 is_settled = False
 
         if auction.skin_in_the_game_required:
-            badge = m.Badge.query.filter_by(badge_id=app.config['SKIN_IN_THE_GAME_BADGE_ID']).first()
-            buyer_awards = birdwatcher.query_badge_award(badge.owner_public_key, request.json['pubkey'])
-            if badge.badge_id not in buyer_awards['awarded_badges']:
+            if badge['badge_id'] not in buyer_awards['awarded_badges']:
                 message = f"User needs Skin in the Game in order to bid."
-                birdwatcher.publish_bid_status(auction, request.json['id'], 'pending', message, badge_stall_id=badge.stall_id, badge_product_id=badge.listing_uuid)
+                birdwatcher.publish_bid_status(auction, event['id'], 'pending', message, badge_stall_id=badge['stall_id'], badge_product_id=badge['listing_uuid'])
                 is_settled = False
 
-    bid = m.Bid(nostr_event_id=request.json['id'], auction=auction, buyer_nostr_public_key=request.json['pubkey'], amount=amount)
-    if is_settled:
-        bid.settled_at = datetime.utcnow()
+    bid = m.Bid(nostr_event_id=event['id'], auction=auction, buyer_nostr_public_key=event['pubkey'], amount=amount)
     db.session.add(bid)
 
-    app.logger.info(f"New bid for merchant {merchant_pubkey} auction {auction_event_id}: {request.json['content']}!")
+    if is_settled:
+        duration_extended = auction.accept_bid(bid)
+        if duration_extended is None:
+            # somebody else placed a higher bid (or the auction ended) since we checked above
+            db.session.rollback()
+            m.ProcessedEvent.mark(event['id'])
+            message = "Auction ended." if auction.ended else "Amount needs to be higher than the previous top bid!"
+            birdwatcher.publish_bid_status(auction, event['id'], 'rejected', message)
+            db.session.commit()
+            return jsonify({'message': message}), 400
 
-    duration_extended = auction.extend()
+    app.logger.info(f"New bid for merchant {merchant_pubkey} auction {auction_event_id}: {event['content']}!")
 
     if is_settled:
-        birdwatcher.publish_bid_status(auction, request.json['id'], 'accepted', duration_extended=duration_extended)
-        if top_bid:
-            birdwatcher.send_dm(merchant.parse_merchant_private_key(), top_bid.buyer_nostr_public_key,
+        birdwatcher.publish_bid_status(auction, event['id'], 'accepted', duration_extended=duration_extended)
+        outbid = auction.get_top_bid(below=amount)
+        if outbid:
+            birdwatcher.send_dm(merchant.parse_merchant_private_key(), outbid.buyer_nostr_public_key,
                                 f"You have been outbid on the auction: {auction.item.title}!")
 
     db.session.commit()
 
     return jsonify({})
+
+@api_blueprint.route("/api/events/batch", methods=['POST'])
+def post_events_batch():
+    # DMs and bids forwarded by birdwatcher, many at once, each processed (in order) as if it was POSTed to its own endpoint
+    events = request.json.get('events') if isinstance(request.json, dict) else None
+    if not isinstance(events, list):
+        return jsonify({'message': "Missing events!"}), 400
+    if len(events) > app.config['EVENTS_BATCH_MAX_SIZE']:
+        return jsonify({'message': f"Too many events! Max {app.config['EVENTS_BATCH_MAX_SIZE']} per batch."}), 400
+
+    # NB: we stop processing events after EVENTS_BATCH_MAX_SECONDS (telling birdwatcher to retry the rest),
+    # so the response gets back (with the results of the events we processed) before the request times out
+    started_at = time.monotonic()
+    results = []
+    for e in events:
+        if time.monotonic() - started_at > app.config['EVENTS_BATCH_MAX_SECONDS']:
+            results.append({'status': 503, 'message': "Not processed. Try again!"})
+            continue
+        if not isinstance(e, dict) or 'merchant_public_key' not in e or not isinstance(e.get('event'), dict):
+            results.append({'status': 400, 'message': "Invalid event!"})
+            continue
+        try:
+            if e.get('auction_event_id'):
+                response = make_response(process_auction_bid(e['merchant_public_key'], e['auction_event_id'], e['event']))
+            else:
+                response = make_response(process_merchant_message(e['merchant_public_key'], e['event']))
+        except Exception:
+            # NB: an event that fails should not fail the other events in the batch
+            app.logger.exception("Error processing event in batch.")
+            response = make_response(jsonify({'message': "Error processing the event!"}), 500)
+        # NB: the handlers commit what they need to keep, but some return errors after changing the session,
+        # which (unlike for single requests, where the session is discarded at teardown) the next event would otherwise commit
+        db.session.rollback()
+        results.append({'status': response.status_code, 'message': (response.get_json(silent=True) or {}).get('message')})
+
+    return jsonify({'results': results})
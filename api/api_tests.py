@@ -1,5 +1,6 @@
 import base64
 import btc2fiat
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import dateutil.parser
 import ecdsa
@@ -10,7 +11,8 @@ import requests
 import time
 import unittest
 
-from main import app
+from main import app, db, Birdwatcher
+import models as m
 from utils import hash_create, usd2sats
 
 # just a one-pixel PNG used for testing
@@ -286,6 +288,20 @@ class TestApi(unittest.TestCase):
         listing_initial_nostr_event_id = response['listing']['nostr_event_id']
         self.assertIsNotNone(listing_initial_nostr_event_id)
 
+        # listings can't be sorted by end date and invalid pagination parameters are rejected
+        code, response = self.get("/api/listings/active", {'sort': 'ending_soon'})
+        self.assertEqual(code, 400)
+        self.assertIn("invalid sort", response['message'].lower())
+        code, response = self.get("/api/listings/active", {'limit': 1000})
+        self.assertEqual(code, 400)
+        code, response = self.get("/api/listings/active", {'limit': 1, 'cursor': "not-a-cursor"})
+        self.assertEqual(code, 400)
+        self.assertIn("invalid cursor", response['message'].lower())
+        for forged_cursor in [["not-a-price", 1], [1.5, "1"], [1.5, 2 ** 40]]:
+            code, response = self.get("/api/listings/active", {'sort': 'price_asc', 'limit': 1, 'cursor': base64.urlsafe_b64encode(json.dumps(forged_cursor).encode('utf-8')).decode('ascii')})
+            self.assertEqual(code, 400)
+            self.assertIn("invalid cursor", response['message'].lower())
+
         # other users cannot add images
         code, response = self.post(f"/api/listings/{listing_key}/media",
             headers=self.get_auth_headers(token_2), json={},
@@ -360,7 +376,14 @@ class TestApi(unittest.TestCase):
         self.assertEqual(code, 200)
         self.assertEqual(len(response['orders']), 0)
 
-        # try to buy the product again
+        # sending the same message again does nothing, since it was already processed (and rejected)...
+        code, response = self.post(f"/api/merchants/{listing_merchant_public_key}/messages", signed_event_json)
+        self.assertEqual(code, 409)
+
+        # ... but we can try to buy the product again
+        purchase_event = EncryptedDirectMessage(recipient_pubkey=listing_merchant_public_key, cleartext_content=json.dumps(purchase_event_json))
+        NOSTR_BUYER_PRIVATE_KEY.sign_event(purchase_event)
+        signed_event_json = json.loads(purchase_event.to_message())[1]
         code, response = self.post(f"/api/merchants/{listing_merchant_public_key}/messages", signed_event_json)
         self.assertEqual(code, 200)
 
@@ -394,6 +417,77 @@ class TestApi(unittest.TestCase):
             headers=self.get_auth_headers(token_2))
         self.assertEqual(code, 404)
 
+    def test_outbox(self):
+        # NB: the drain-outbox worker is running, so the events we create are only due in the future, where it doesn't look for them
+        later = datetime.utcnow() + timedelta(days=1)
+
+        def sign_event():
+            event = Event(kind=1, content=f"outbox test {hash_create(8)}")
+            NOSTR_PRIVATE_KEY_1.sign_event(event)
+            return event
+
+        def get_outbox_event(event_id):
+            return [e for e in m.OutboxEvent.query.all() if e.event['id'] == event_id]
+
+        # events are added to the outbox together with the rest of the transaction...
+        birdwatcher = Birdwatcher(app.config['BIRDWATCHER_BASE_URL'])
+        committed_event = sign_event()
+        self.assertTrue(birdwatcher.post_event(committed_event))
+        [outbox_event] = [e for e in db.session.new if isinstance(e, m.OutboxEvent)]
+        outbox_event.next_attempt_at = later
+        db.session.commit()
+        self.assertEqual(len(get_outbox_event(committed_event.id)), 1)
+
+        # ... so they are not posted at all if it is rolled back
+        rolled_back_event = sign_event()
+        self.assertTrue(birdwatcher.post_event(rolled_back_event))
+        db.session.rollback()
+        self.assertEqual(get_outbox_event(rolled_back_event.id), [])
+
+        # events claimed by one worker are skipped by the others, until the first one is done with them
+        other_event = m.OutboxEvent(event={'id': sign_event().id}, next_attempt_at=later)
+        db.session.add(other_event)
+        db.session.commit()
+        test_event_ids = {outbox_event.id, other_event.id}
+
+        def claim_in_other_worker():
+            with app.app_context():
+                return {e.id for e in m.OutboxEvent.claim_batch(100, now=later)} & test_event_ids
+
+        claimed = m.OutboxEvent.claim_batch(1, now=later)
+        self.assertEqual([e.id for e in claimed], [outbox_event.id])
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(executor.submit(claim_in_other_worker).result(), {other_event.id})
+        db.session.rollback()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(executor.submit(claim_in_other_worker).result(), test_event_ids)
+
+        # events that could not be posted are retried with exponential backoff...
+        outbox_event = m.OutboxEvent.query.filter_by(id=outbox_event.id).one()
+        for attempt in range(1, 4):
+            before = datetime.utcnow()
+            self.assertTrue(outbox_event.retry_later())
+            self.assertEqual(outbox_event.attempts, attempt)
+            self.assertGreaterEqual(outbox_event.next_attempt_at, before + timedelta(seconds=2 ** attempt))
+            self.assertLess(outbox_event.next_attempt_at, datetime.utcnow() + timedelta(seconds=2 ** attempt + 1))
+        self.assertIsNone(outbox_event.failed_at)
+
+        # ... up to MAX_RETRY_DELAY between attempts ...
+        outbox_event.attempts = 20
+        self.assertTrue(outbox_event.retry_later())
+        self.assertLessEqual(outbox_event.next_attempt_at, datetime.utcnow() + m.OutboxEvent.MAX_RETRY_DELAY)
+
+        # ... and marked as failed (and not claimed anymore) after MAX_ATTEMPTS
+        outbox_event.attempts = m.OutboxEvent.MAX_ATTEMPTS - 1
+        self.assertFalse(outbox_event.retry_later())
+        self.assertIsNotNone(outbox_event.failed_at)
+        db.session.commit()
+        self.assertEqual({e.id for e in m.OutboxEvent.claim_batch(100, now=later + m.OutboxEvent.MAX_RETRY_DELAY)} & test_event_ids, {other_event.id})
+        db.session.rollback()
+
+        m.OutboxEvent.query.filter(m.OutboxEvent.id.in_(test_event_ids)).delete()
+        db.session.commit()
+
     def test_000_user(self):
         key_1 = PrivateKey()
 
@@ -641,6 +735,8 @@ class TestApi(unittest.TestCase):
         self.assertEqual(code, 200)
         self.assertEqual(response['user']['has_items'], True)
         self.assertEqual(response['user']['has_own_items'], True)
+        self.assertEqual(response['user']['has_active_auctions'], False)
+        self.assertEqual(response['user']['has_past_auctions'], False)
 
         # GET auctions to find auction in our "not running" section
         code, response = self.get("/api/users/me/auctions?filter=new",
@@ -765,8 +861,21 @@ class TestApi(unittest.TestCase):
         self.assertIsNotNone(auction_after_edit_nostr_event_id)
         self.assertNotEqual(auction_after_edit_nostr_event_id, auction_initial_nostr_event_id)
 
+        # the list of merchants can be revalidated using its ETag...
+        merchants_url = f"{app.config['API_BASE_URL']}/api/merchants"
+        response = requests.get(merchants_url)
+        self.assertEqual(response.status_code, 200)
+        merchants_etag = response.headers['ETag']
+        response = requests.get(merchants_url, headers={'If-None-Match': merchants_etag})
+        self.assertEqual(response.status_code, 304)
+
         token_3 = self.nostr_auth(PrivateKey())
 
+        # ... which changes as soon as a new merchant is added
+        response = requests.get(merchants_url, headers={'If-None-Match': merchants_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], merchants_etag)
+
         # try to place bid > reserve price
         above_threshold_sats = 69421
         huge_bid_event = Event(kind=BID_NOSTR_EVENT_KIND, content=str(above_threshold_sats))
@@ -782,6 +891,17 @@ class TestApi(unittest.TestCase):
         self.assertEqual(len(response['auction']['bids']), 0)
         self.assertIsNone(response['auction']['has_winner'])
 
+        code, response = self.get("/api/auctions/active")
+        self.assertEqual(code, 200)
+        self.assertEqual(len([a for a in response['auctions'] if a['key'] == auction_key][0]['bids']), 0)
+
+        # the buyer's metadata shows they have no Skin in the Game (the second time from the cache)
+        for _ in range(2):
+            code, response = self.get(f"/api/keys/{NOSTR_BUYER_PRIVATE_KEY.public_key.hex()}/metadata")
+            self.assertEqual(code, 200)
+            self.assertEqual(response['verified_identities'], [])
+            self.assertFalse(response['has_skin_in_the_game'])
+
         # place a bid
         code, response = self.post(f"/api/merchants/{auction_merchant_public_key}/auctions/{auction_after_edit_nostr_event_id}/bids", signed_event_json)
         self.assertEqual(code, 200)
@@ -793,6 +913,11 @@ class TestApi(unittest.TestCase):
         self.assertEqual(len(response['auction']['bids']), 1)
         self.assertIsNone(response['auction']['has_winner'])
 
+        # the (cached) list of active auctions also shows the new bid
+        code, response = self.get("/api/auctions/active")
+        self.assertEqual(code, 200)
+        self.assertEqual(len([a for a in response['auctions'] if a['key'] == auction_key][0]['bids']), 1)
+
         # try to buy the badge
         code, response = self.get(f"/api/listings/{app.config['SKIN_IN_THE_GAME_BADGE_ID']}")
         self.assertEqual(code, 200)
@@ -823,6 +948,11 @@ class TestApi(unittest.TestCase):
         self.assertEqual(code, 200)
         self.assertEqual(len(response['auction']['bids']), 2)
 
+        # the badge award was recorded in our ledger, so the buyer now has Skin in the Game (the mocked relays never return any awards)
+        code, response = self.get(f"/api/keys/{NOSTR_BUYER_PRIVATE_KEY.public_key.hex()}/metadata")
+        self.assertEqual(code, 200)
+        self.assertTrue(response['has_skin_in_the_game'])
+
         # cannot EDIT the auction anymore once it has a bid
         code, response = self.put(f"/api/auctions/{auction_key}",
             {'starting_bid': 102},
@@ -844,6 +974,24 @@ class TestApi(unittest.TestCase):
         self.assertEqual(code, 400)
         self.assertIn("amount needs to be higher", response['message'].lower())
 
+        # events can also be POSTed in batches, getting a status for each of them
+        code, response = self.post("/api/events/batch", {'events': [
+            {'merchant_public_key': auction_merchant_public_key, 'auction_event_id': auction_after_edit_nostr_event_id, 'event': signed_lower_event_json},
+            {'merchant_public_key': auction_merchant_public_key, 'auction_event_id': auction_after_edit_nostr_event_id, 'event': copy_of_signed_event_json},
+            {'merchant_public_key': PrivateKey().public_key.hex(), 'event': signed_event_json},
+            {'event': signed_event_json},
+            {'merchant_public_key': auction_merchant_public_key, 'auction_event_id': auction_after_edit_nostr_event_id, 'event': signed_huge_event_json},
+            {'merchant_public_key': site_admin_merchant_public_key, 'event': signed_event_json},
+        ]})
+        self.assertEqual(code, 200)
+        # ... and the events that were already processed (even if they were rejected) are not processed again
+        self.assertEqual([r['status'] for r in response['results']], [409, 400, 404, 400, 409, 409])
+        self.assertIn("already processed", response['results'][0]['message'].lower())
+        self.assertIn("invalid event id", response['results'][1]['message'].lower())
+
+        code, response = self.post("/api/events/batch", {})
+        self.assertEqual(code, 400)
+
         # create an auction without a start date
         code, response = self.post("/api/users/me/auctions",
             {'title': "Auction without start date",
@@ -880,6 +1028,79 @@ class TestApi(unittest.TestCase):
         self.assertEqual(response['auction']['ended'], False)
         self.assertEqual(dateutil.parser.isoparse(response['auction']['start_date']) + timedelta(hours=24), dateutil.parser.isoparse(response['auction']['end_date']))
 
+        # the auction shows up in the active auctions, which can be filtered...
+        code, response = self.get("/api/auctions/active")
+        self.assertEqual(code, 200)
+        all_active_auction_keys = [a['key'] for a in response['auctions']]
+        self.assertIn(auction_key_3, all_active_auction_keys)
+        self.assertIsNone(response['next_cursor'])
+        auction_3_merchant_public_key = [a for a in response['auctions'] if a['key'] == auction_key_3][0]['merchant_public_key']
+        code, response = self.get("/api/auctions/active", {'seller': auction_3_merchant_public_key, 'price_min': 10, 'price_max': 10})
+        self.assertEqual(code, 200)
+        self.assertEqual([a['key'] for a in response['auctions']], [auction_key_3])
+        code, response = self.get("/api/auctions/active", {'seller': auction_3_merchant_public_key, 'price_min': 11})
+        self.assertEqual(code, 200)
+        self.assertEqual(len(response['auctions']), 0)
+        code, response = self.get("/api/auctions/active", {'category': "inexisting category"})
+        self.assertEqual(code, 200)
+        self.assertEqual(len(response['auctions']), 0)
+
+        # ... and paginated, one page at a time, yielding the same auctions as the full list
+        paginated_auction_keys = []
+        cursor = None
+        while True:
+            code, response = self.get("/api/auctions/active", {'limit': 1, 'cursor': cursor} if cursor else {'limit': 1})
+            self.assertEqual(code, 200)
+            self.assertLessEqual(len(response['auctions']), 1)
+            paginated_auction_keys.extend(a['key'] for a in response['auctions'])
+            cursor = response['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(paginated_auction_keys, all_active_auction_keys)
+
+        code, response = self.get("/api/auctions/active", {'sort': 'newest', 'limit': 100})
+        self.assertEqual(code, 200)
+        self.assertEqual([a['key'] for a in response['auctions']], list(reversed(all_active_auction_keys)))
+
+        # ... and sorted by end date
+        code, response = self.get("/api/auctions/active", {'sort': 'ending_soon'})
+        self.assertEqual(code, 200)
+        self.assertIn(auction_key_3, [a['key'] for a in response['auctions']])
+        end_dates = [a['end_date'] for a in response['auctions']]
+        self.assertEqual(end_dates, sorted(end_dates))
+        code, response = self.get("/api/auctions/active", {'sort': 'ending_soon', 'limit': 1})
+        self.assertEqual(code, 200)
+        self.assertEqual(len(response['auctions']), 1)
+        self.assertEqual(response['auctions'][0]['end_date'], end_dates[0])
+
+        # bid storm: many concurrent bids on the same auction
+        code, response = self.get(f"/api/auctions/{auction_key_3}")
+        self.assertEqual(code, 200)
+        auction_3_nostr_event_id = response['auction']['nostr_event_id']
+
+        def place_bid(amount):
+            bid_event = Event(kind=BID_NOSTR_EVENT_KIND, content=str(amount))
+            PrivateKey().sign_event(bid_event)
+            code, _ = self.post(f"/api/merchants/{auction_3_merchant_public_key}/auctions/{auction_3_nostr_event_id}/bids", json.loads(bid_event.to_message())[1])
+            return code
+
+        # ... out of several bids with the same amount, only one gets accepted
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            codes = list(executor.map(place_bid, [100] * 10))
+        self.assertEqual(codes.count(200), 1)
+        self.assertEqual(codes.count(400), 9)
+
+        # ... and out of several increasing bids, the highest one always ends up being the top bid
+        amounts = list(range(101, 131))
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            codes = list(executor.map(place_bid, amounts))
+        self.assertEqual(codes[-1], 200)
+        code, response = self.get(f"/api/auctions/{auction_key_3}")
+        self.assertEqual(code, 200)
+        bid_amounts = [b['amount'] for b in response['auction']['bids']]
+        self.assertEqual(sorted(bid_amounts), [100] + [amount for amount, code in zip(amounts, codes) if code == 200])
+        self.assertEqual(bid_amounts[0], 130)
+
         # Create an auction with malicious input to description
         malicious_desc = '''<script type="text/javascript">alert("malicious")</script>'''
         code, response = self.post("/api/users/me/auctions",
@@ -909,6 +1130,12 @@ class TestApi(unittest.TestCase):
         self.assertEqual(code, 200)
         self.assertNotIn(auction_key, [a['key'] for a in response['auctions']])
 
+        # ... and the user has past auctions
+        code, response = self.get("/api/users/me",
+            headers=self.get_auth_headers(token_1))
+        self.assertEqual(code, 200)
+        self.assertEqual(response['user']['has_past_auctions'], True)
+
         # auction should have a winner now
         code, response = self.get(f"/api/auctions/{auction_key}",
             headers=self.get_auth_headers(token_2))
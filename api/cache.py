@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+class ResponseCache:
+    """
+    An in-process LRU cache for the payloads of public GET endpoints.
+
+    Each entry is stored together with the version of the data it was built from
+    (the versions of the collections it depends on - see models.State.get_versions - and the next time-based transition, if any).
+    Writes bump the collection versions in the database, in a short transaction right after the write itself commits,
+    so an entry built by any API worker becomes stale as soon as any process (API or CLI worker) commits a change.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry_version, payload = entry
+            if entry_version != version:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return payload
+
+    def set(self, key, version, payload):
+        with self.lock:
+            self.entries[key] = (version, payload)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_or_build(self, key, version, build):
+        """
+        Return the cached payload for `key`, or call `build` to build it.
+        NB: `version` needs to be read *before* building, so the cached payload is never older than the version it is stored with.
+        """
+        payload = self.get(key, version)
+        if payload is None:
+            payload = build()
+            self.set(key, version, payload)
+        return payload
+
+class TTLCache(ResponseCache):
+    """
+    Like ResponseCache, but each entry also expires after its own TTL (or never, if the TTL is None).
+    Used for data we get from Nostr relays (via birdwatcher), where we can't know when it changes (unless we change it ourselves).
+    """
+
+    def get(self, key, version):
+        entry = super().get(key, version)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            with self.lock:
+                self.entries.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, version, value, ttl=None):
+        super().set(key, version, (time.monotonic() + ttl if ttl is not None else None, value))
@@ -17,6 +17,19 @@ PROPAGATE_EXCEPTIONS = False
 
 BID_LAST_MINUTE_EXTEND = int(os.environ.get('BID_LAST_MINUTE_EXTEND', 5))
 
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1000))
+ETAG_TIME_BUCKET_SECONDS = int(os.environ.get('ETAG_TIME_BUCKET_SECONDS', 10))
+
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 50))
+EVENTS_BATCH_MAX_SIZE = int(os.environ.get('EVENTS_BATCH_MAX_SIZE', 100))
+EVENTS_BATCH_MAX_SECONDS = int(os.environ.get('EVENTS_BATCH_MAX_SECONDS', 10))
+
+# metadata and badge awards queried from Nostr (see main.query_metadata_cached and main.query_skin_in_the_game_cached)
+NOSTR_CACHE_MAX_ENTRIES = int(os.environ.get('NOSTR_CACHE_MAX_ENTRIES', 10000))
+NOSTR_METADATA_CACHE_TTL = int(os.environ.get('NOSTR_METADATA_CACHE_TTL', 300))
+NOSTR_BADGE_AWARD_CACHE_TTL = int(os.environ.get('NOSTR_BADGE_AWARD_CACHE_TTL', 3600)) # awarded badges are (practically) never taken back...
+NOSTR_NO_BADGE_AWARD_CACHE_TTL = int(os.environ.get('NOSTR_NO_BADGE_AWARD_CACHE_TTL', 30)) # ...but badges awarded by other instances can show up any time
+
 if DEBUG:
     SECRET_KEY = "DEBUG_SECRET_KEY_IS_NOT_REALLY_SECRET"
 else:
@@ -28,6 +28,7 @@ import time
 import uuid
 from lnd_hub_client import LndHubClient, MockLndHubClient
 
+from cache import ResponseCache, TTLCache
 from extensions import cors, db, mail
 from nostr_utils import EventValidationError, validate_event, get_nip98_pubkey
 from utils import hash_create
@@ -89,6 +90,9 @@ import models as m
 
 migrate = Migrate(app, db)
 
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_MAX_ENTRIES'])
+nostr_cache = TTLCache(app.config['NOSTR_CACHE_MAX_ENTRIES'])
+
 @app.cli.command("run-tests")
 @with_appcontext
 def run_tests():
@@ -182,6 +186,38 @@ def finalize_auctions():
         else:
             time.sleep(5)
 
+@app.cli.command("drain-outbox")
+@with_appcontext
+def drain_outbox():
+    app.logger.setLevel(getattr(logging, LOG_LEVEL))
+    signal.signal(signal.SIGTERM, lambda _, __: sys.exit(0))
+
+    birdwatcher = get_birdwatcher()
+
+    app.logger.info("Starting drain-outbox process...")
+
+    while True:
+        batch_full = False
+        try:
+            outbox_events = m.OutboxEvent.claim_batch(app.config['OUTBOX_BATCH_SIZE'])
+            batch_full = len(outbox_events) == app.config['OUTBOX_BATCH_SIZE']
+            results = birdwatcher.post_events_json([outbox_event.event for outbox_event in outbox_events]) if outbox_events else None
+            for outbox_event in outbox_events:
+                result = (results or {}).get(outbox_event.event['id'], {})
+                if result.get('quorum_reached'):
+                    db.session.delete(outbox_event)
+                elif outbox_event.retry_later():
+                    app.logger.warning(f"Failed to post event {outbox_event.event['id']} (attempt {outbox_event.attempts}): {result.get('relays')}. Will retry at {outbox_event.next_attempt_at}.")
+                else:
+                    app.logger.error(f"Failed to post event {outbox_event.event['id']} (attempt {outbox_event.attempts}): {result.get('relays')}. Giving up!")
+            db.session.commit()
+        except:
+            app.logger.exception("Error while draining the outbox. Will roll back and retry.")
+            db.session.rollback()
+
+        if not batch_full: # otherwise there are probably more events waiting, so we go on right away
+            time.sleep(1)
+
 @app.cli.command("settle-btc-payments")
 @with_appcontext
 def settle_btc_payments():
@@ -268,9 +304,10 @@ def award_badge_skin_in_the_game(order):
         if not birdwatcher.send_dm(order.seller.parse_merchant_private_key(), order.buyer_public_key,
             json.dumps({'id': order.uuid, 'type': 2, 'paid': True, 'shipped': True, 'message': "Skin in the Game badge awarded!"})):
             app.logger.error("Error sending Nostr reply to the buyer while trying to award the badge.")
+        db.session.commit()
         for pending_bid in m.Bid.query.filter_by(buyer_nostr_public_key=order.buyer_public_key, settled_at=None).all():
             previous_top_bid = pending_bid.auction.get_top_bid()
-            pending_bid.settled_at = datetime.utcnow()
+            pending_bid.settle()
             duration_extended = pending_bid.auction.extend()
             birdwatcher.publish_bid_status(pending_bid.auction, pending_bid.nostr_event_id, 'accepted', duration_extended=duration_extended)
             if previous_top_bid:
@@ -385,6 +422,7 @@ def settle_lightning_payments():
                                     if not birdwatcher.send_dm(order.seller.parse_merchant_private_key(), order.buyer_public_key,
                                         json.dumps({'id': order.uuid, 'type': 2, 'paid': True, 'shipped': False, 'message': f"Payment confirmed"})):
                                         app.logger.info(f"        -  ERROR SENDING DM WITH TYPE=2, PAID=TRUE: {incoming_invoice}")
+                                    db.session.commit()
 
                                 else:
                                     app.logger.debug(f"But not yet paid ****")
@@ -442,6 +480,7 @@ def settle_lightning_payments():
 
             except:
                 app.logger.exception("Error while getting information about Lightning Network payments.")
+                db.session.rollback()
 
         else:
             app.logger.debug(f"There aren't active orders with Lightning Network payments pending. Sleeping for a while.")
@@ -667,14 +706,25 @@ class Birdwatcher:
             return False
 
     def post_event(self, event):
+        # NB: the event is not posted right away, but added to the outbox, to be committed together with the rest of the session
+        # and posted by the drain-outbox worker (see OutboxEvent)
         event_json = json.loads(event.to_message())[1] # ugly as hell. maybe we should just completely get rid of this python-nostr library, it's been a pain in the ass!
-        response = requests.post(f"{self.base_url}/events", json=event_json)
+        db.session.add(m.OutboxEvent(event=event_json))
+        return True
+
+    def post_events_json(self, events_json):
+        # returns a dict of event ID => {'relays': {relay URL => result}, 'quorum_reached': ...} or None if the batch could not be posted
+        try:
+            response = requests.post(f"{self.base_url}/events/batch", json={'events': events_json}, timeout=30)
+        except requests.exceptions.RequestException:
+            app.logger.exception(f"Error POSTing {len(events_json)} events to birdwatcher!")
+            return None
         if response.status_code == 200:
-            app.logger.info(f"Successfully POSTed event {event.id} to birdwatcher: {event_json=}!")
-            return True
+            app.logger.info(f"Successfully POSTed {len(events_json)} events to birdwatcher: {[e['id'] for e in events_json]}!")
+            return {e['id']: e for e in response.json()['events']}
         else:
-            app.logger.error(f"Error POSTing event {event.id} to birdwatcher!")
-            return False
+            app.logger.error(f"Error POSTing {len(events_json)} events to birdwatcher: {response.status_code}!")
+            return None
 
     def send_dm(self, sender_private_key, recipient_public_key, body):
         try:
@@ -779,10 +829,14 @@ class Birdwatcher:
                 badge_id_tag = badge_id
             event = Event(kind=8, content="", tags=[['a', f"30009:{self.site_admin_private_key.public_key.hex()}:{badge_id_tag}"], ['p', pubkey]])
             self.site_admin_private_key.sign_event(event)
-            if self.post_event(event):
-                return event.id
+            if not self.post_event(event):
+                return
         except:
             app.logger.exception(f"Error publishing badge award via birdwatcher!")
+            return
+        # NB: this writes to the database, so errors must not be swallowed (they would leave the session's transaction aborted)
+        m.BadgeAward.record(badge_id, pubkey, event.id)
+        return event.id
 
 class MockingBirdwatcher:
     def query_metadata(self, _public_key):
@@ -795,6 +849,10 @@ class MockingBirdwatcher:
         app.logger.info(f"add_relay url={relay_url}")
         return True
 
+    def post_events_json(self, events_json):
+        app.logger.info(f"post_events_json ids={[e['id'] for e in events_json]}")
+        return {e['id']: {'relays': {'mock': 'ok'}, 'quorum_reached': True} for e in events_json}
+
     def send_dm(self, sender_private_key, recipient_public_key, body):
         app.logger.info(f"from={sender_private_key.hex()} to={recipient_public_key} {body=}")
         return hash_create(4)
@@ -831,7 +889,9 @@ class MockingBirdwatcher:
 
     def publish_badge_award(self, badge_id, pubkey):
         app.logger.info(f"publish_badge_award {badge_id=} {pubkey=}")
-        return hash_create(4)
+        event_id = hash_create(4)
+        m.BadgeAward.record(badge_id, pubkey, event_id)
+        return event_id
 
 def get_birdwatcher():
     if app.config['ENV'] in ('staging', 'prod', 'dev'):
@@ -839,6 +899,61 @@ def get_birdwatcher():
     else:
         return MockingBirdwatcher()
 
+class NostrQueryError(Exception):
+    """We could not find out what relays know (birdwatcher did not answer), which is not the same as relays not knowing anything."""
+    def __str__(self):
+        return "Error querying Nostr relays! Please try again."
+
+def query_metadata_cached(pubkey):
+    """
+    Return the metadata of `pubkey` (see Birdwatcher.query_metadata), cached for NOSTR_METADATA_CACHE_TTL seconds.
+    Raises NostrQueryError if birdwatcher could not be queried.
+    NB: the returned dict is shared by all requests, so it must not be modified!
+    """
+    key = ('metadata', pubkey)
+    metadata = nostr_cache.get(key, None)
+    if metadata is None:
+        metadata = get_birdwatcher().query_metadata(pubkey)
+        if metadata is None:
+            raise NostrQueryError()
+        nostr_cache.set(key, None, metadata, app.config['NOSTR_METADATA_CACHE_TTL'])
+    return metadata
+
+def query_skin_in_the_game_cached(pubkey):
+    """
+    Return the Skin in the Game badge and the badges awarded by its owner to `pubkey` (see Birdwatcher.query_badge_award).
+    Awards found in our ledger (see BadgeAward) are returned right away. Otherwise, if the badge is our own, the ledger is authoritative,
+    and for inherited badges (owned by another key) we ask relays.
+    The badge is cached until any badge changes and the awards until we award a badge ourselves or their TTL expires.
+    Raises NostrQueryError if we need to ask relays, but birdwatcher could not be queried.
+    NB: the returned dicts are shared by all requests, so they must not be modified!
+    """
+    badges_version, badge_awards_version = m.State.get_versions(['badges', 'badge_awards'])
+
+    badge_id = app.config['SKIN_IN_THE_GAME_BADGE_ID']
+    badge = nostr_cache.get(('badge', badge_id), badges_version)
+    if badge is None:
+        badge = m.Badge.query.filter_by(badge_id=badge_id).first()
+        badge = {**badge.to_dict(), 'owner_public_key': badge.owner_public_key}
+        nostr_cache.set(('badge', badge_id), badges_version, badge)
+
+    key = ('badge_awards', badge['owner_public_key'], pubkey)
+    awards = nostr_cache.get(key, badge_awards_version)
+    if awards is None:
+        # NB: awards are recorded under the owner of the badge (see BadgeAward.record), so this is also how we look them up
+        awarded_badges = m.BadgeAward.get_awarded_badges(badge['owner_public_key'], pubkey)
+        if badge_id in awarded_badges or badge['owner_public_key'] == app.config['NOSTR_PRIVATE_KEY'].public_key.hex():
+            awards = {'awarded_badges': awarded_badges}
+            nostr_cache.set(key, badge_awards_version, awards)
+    if awards is None:
+        awards = get_birdwatcher().query_badge_award(badge['owner_public_key'], pubkey)
+        if awards is None:
+            raise NostrQueryError()
+        ttl = app.config['NOSTR_BADGE_AWARD_CACHE_TTL'] if badge_id in awards['awarded_badges'] else app.config['NOSTR_NO_BADGE_AWARD_CACHE_TTL']
+        nostr_cache.set(key, badge_awards_version, awards, ttl)
+
+    return badge, awards
+
 class MockFileStorage:
     def get_url_prefix(self):
         return app.config['API_BASE_URL_EXTERNAL'] + "/mock-s3-files/"
@@ -989,6 +1104,7 @@ def award_badge_tester(pubkey):
 
     if not birdwatcher.publish_badge_award(badge_def['badge_id'], pubkey):
         click.echo("Failed to publish badge award!")
+    db.session.commit()
 
 @app.cli.command("configure-default-relays")
 @with_appcontext
@@ -1000,6 +1116,18 @@ def configure_default_relays():
         db.session.add(m.Relay(url=relay_url))
     db.session.commit()
 
+@app.cli.command("rebuild-stall-stats")
+@click.option("--user-id", type=click.INT, default=None)
+@with_appcontext
+def rebuild_stall_stats(user_id):
+    """
+    Rebuild the stall statistics (see StallStats) of a user or, if no user is specified, of all users.
+    """
+    user_ids = [user_id] if user_id is not None else [user_id for user_id, in db.session.query(m.User.id).all()]
+    for user_id in user_ids:
+        m.StallStats.rebuild(user_id)
+    app.logger.info(f"Rebuilt stall stats for {len(user_ids)} users.")
+
 @app.cli.command("configure-site")
 @with_appcontext
 def configure_site_cmd():
@@ -1,14 +1,21 @@
+import base64
+import binascii
 import bip39gen
 import bleach
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
 import dateutil.parser
 from enum import Enum
 import hashlib
 from itertools import chain
+import json
 import jwt
 import math
 from nostr.key import PrivateKey
-from sqlalchemy.dialects.postgresql import JSON, UUID
+from sqlalchemy import event, select, tuple_, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.postgresql import insert, JSON, UUID
+from sqlalchemy.orm import joinedload, selectinload
 from sqlalchemy.sql.functions import func
 import uuid
 
@@ -99,6 +106,82 @@ class State(db.Model):
     key = db.Column(db.String(32), primary_key=True)
     value = db.Column(db.String(256), nullable=True)
 
+    # collections of cached data, whose versions are kept in this table (see CACHED_COLLECTIONS on models)
+    VERSION_PREFIX = 'VERSION_'
+
+    @classmethod
+    def get_versions(cls, collections):
+        keys = [cls.VERSION_PREFIX + c for c in collections]
+        versions = dict(db.session.query(cls.key, cls.value).filter(cls.key.in_(keys)).all())
+        return tuple(int(versions.get(k, 0)) for k in keys)
+
+    PENDING_VERSION_BUMPS = 'pending_version_bumps'
+
+    @classmethod
+    def bump_versions(cls, connection, collections):
+        stmt = insert(cls).values([{'key': cls.VERSION_PREFIX + c, 'value': '1'} for c in sorted(collections)])
+        stmt = stmt.on_conflict_do_update(index_elements=[cls.key], set_={'value': db.cast(db.cast(cls.value, db.Integer) + 1, db.String)})
+        connection.execute(stmt)
+
+    @classmethod
+    def bump_versions_on_commit(cls, session, collections):
+        # NB: the versions are bumped in a separate (short) transaction right after the session commits (see bump_pending_versions),
+        # rather than in the transaction of the change itself, where the locks on these few rows would serialize all writes until they commit
+        session.info.setdefault(cls.PENDING_VERSION_BUMPS, set()).update(collections)
+
+class OutboxEvent(db.Model):
+    """
+    Signed Nostr events waiting to be posted to birdwatcher.
+    They are added to the session by Birdwatcher.post_event, so they get committed (or rolled back) together with the change they are about,
+    and then posted by the drain-outbox worker, which retries with exponential backoff if birdwatcher is not available.
+    Events that still could not be posted after MAX_ATTEMPTS are marked as failed and kept (but not retried), so they can be looked into.
+    """
+    __tablename__ = 'outbox_events'
+
+    MAX_RETRY_DELAY = timedelta(hours=1)
+    MAX_ATTEMPTS = 30 # NB: about a day, given MAX_RETRY_DELAY
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    event = db.Column(JSON, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    failed_at = db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def claim_batch(cls, size, now=None):
+        # NB: rows that are locked by another worker are skipped, so multiple workers can drain the outbox at the same time
+        now = now or datetime.utcnow()
+        return cls.query.filter(cls.failed_at == None, cls.next_attempt_at <= now).order_by(cls.id).limit(size).with_for_update(skip_locked=True).all()
+
+    def retry_later(self):
+        """Schedule the next attempt, unless this was the last one, in which case the event is marked as failed. Returns whether it will be retried."""
+        self.attempts += 1
+        if self.attempts >= self.MAX_ATTEMPTS:
+            self.failed_at = datetime.utcnow()
+            return False
+        self.next_attempt_at = datetime.utcnow() + min(timedelta(seconds=2 ** self.attempts), self.MAX_RETRY_DELAY)
+        return True
+
+class ProcessedEvent(db.Model):
+    """
+    IDs of the Nostr events (DMs and bids) forwarded by birdwatcher that we already processed.
+    Birdwatcher can forward the same event again (if it did not get our response), in which case we must not send DMs, invoices, bid statuses etc again.
+    The ID is added to the session before processing the event, so it gets committed together with the first thing the event causes.
+    """
+    __tablename__ = 'processed_events'
+
+    event_id = db.Column(db.String(64), primary_key=True)
+    processed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def is_processed(cls, event_id):
+        return db.session.get(cls, event_id) is not None
+
+    @classmethod
+    def mark(cls, event_id):
+        db.session.add(cls(event_id=event_id))
+
 class LnAuth(db.Model):
     __tablename__ = 'lnauth'
 
@@ -110,6 +193,8 @@ class LnAuth(db.Model):
 class User(WalletMixin, db.Model):
     __tablename__ = 'users'
 
+    CACHED_COLLECTIONS = ['merchants', 'auctions', 'listings']
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     registered_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
@@ -286,24 +371,14 @@ class User(WalletMixin, db.Model):
             'stall_banner_url': self.stall_banner_url,
             'stall_name': self.stall_name,
             'stall_description': self.stall_description,
-            'has_items': False,
-            'has_own_items': False,
-            'has_active_auctions': False,
-            'has_past_auctions': False,
-            'has_active_listings': False,
-            'has_past_listings': False,
             'merchant_public_key': self.merchant_public_key,
             'stall_id': self.stall_id,
         }
 
-        for item in self.items.all():
-            d['has_items'] = True
-            d['has_own_items'] = True
-            for entity in chain(item.auctions, item.listings):
-                if entity.state in ('active', 'past'):
-                    d[f'has_{entity.state}_{entity.__tablename__}'] = True
-            if d['has_own_items'] and d['has_active_auctions'] and d['has_past_auctions'] and d['has_active_listings'] and d['has_past_listings']:
-                break # short-circuit
+        stall_stats = StallStats.get(self.id)
+        d['has_items'] = d['has_own_items'] = stall_stats.item_count > 0
+        for k in ['active_auctions', 'past_auctions', 'active_listings', 'past_listings']:
+            d[f'has_{k}'] = getattr(stall_stats, f'{k[:-1]}_count') > 0
 
         if for_user == self.id:
             # only ever show these fields to the actual user
@@ -322,6 +397,8 @@ class User(WalletMixin, db.Model):
 class Badge(db.Model):
     __tablename__ = 'badges'
 
+    CACHED_COLLECTIONS = ['badges']
+
     badge_id = db.Column(db.String(32), nullable=False, primary_key=True)
     owner_public_key = db.Column(db.String(64), nullable=False)
 
@@ -343,6 +420,36 @@ class Badge(db.Model):
             'listing_uuid': self.listing_uuid,
         }
 
+class BadgeAward(db.Model):
+    """
+    Badge awards published by this site (see Birdwatcher.publish_badge_award), keyed by the owner of the badge (see Badge).
+    For badges we own, this is the authoritative list of awards, so we don't need to ask relays about them.
+    """
+    __tablename__ = 'badge_awards'
+    __table_args__ = (
+        db.UniqueConstraint('badge_owner_public_key', 'public_key', 'badge_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    badge_owner_public_key = db.Column(db.String(64), nullable=False)
+    badge_id = db.Column(db.String(32), nullable=False)
+    public_key = db.Column(db.String(64), nullable=False)
+    nostr_event_id = db.Column(db.String(64), nullable=True) # NB: unknown for awards published before we kept track of them
+    awarded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def record(cls, badge_id, public_key, nostr_event_id):
+        # NB: badges can be awarded more than once (for example the OG badge, when the user verifies again), but we only keep the first award
+        badge_owner_public_key = select(Badge.owner_public_key).where(Badge.badge_id == badge_id).scalar_subquery()
+        stmt = insert(cls).values(badge_owner_public_key=badge_owner_public_key, badge_id=badge_id, public_key=public_key, nostr_event_id=nostr_event_id, awarded_at=datetime.utcnow())
+        db.session.execute(stmt.on_conflict_do_nothing())
+        # invalidate the badge awards cached by all processes (see main.query_skin_in_the_game_cached), once the award is committed
+        State.bump_versions_on_commit(db.session, ['badge_awards'])
+
+    @classmethod
+    def get_awarded_badges(cls, badge_owner_public_key, public_key):
+        return [award.badge_id for award in cls.query.filter_by(badge_owner_public_key=badge_owner_public_key, public_key=public_key).order_by(cls.id)]
+
 class Relay(db.Model):
     __tablename__ = 'relays'
 
@@ -358,6 +465,25 @@ class UserRelay(db.Model):
     relay = db.relationship('Relay')
 
 class StateFilterMixin:
+    # the attributes `state` depends on (other than the current time), in the order compute_state takes them
+    STATE_ATTRIBUTES = []
+
+    @property
+    def state(self):
+        return self.compute_state(*[getattr(self, a) for a in self.STATE_ATTRIBUTES])
+
+    def get_committed_state(self):
+        """The state as it is in the database, ignoring any pending changes."""
+        values = []
+        for a in self.STATE_ATTRIBUTES:
+            history = db.inspect(self).attrs[a].history
+            values.append((history.deleted[0] if history.deleted else None) if history.has_changes() else getattr(self, a))
+        return self.compute_state(*values)
+
+    def get_seller_id(self):
+        item = self.item or db.session.get(Item, self.item_id)
+        return item.seller.id if item.seller else item.seller_id
+
     def filter_state(self, state, for_user_id):
         is_owner = for_user_id == self.owner_id
         if state is None:
@@ -367,6 +493,114 @@ class StateFilterMixin:
         else:
             return self.state == state
 
+class CatalogMixin:
+    """
+    Queries and serializes pages of auctions / listings for the catalog endpoints.
+    Serialization happens in a constant number of queries, rather than lazily loading the item, seller, media, bids and categories of each entity,
+    and pagination uses the (sort column, id) of the last entity as a cursor, so that every page costs the same, no matter how deep.
+    """
+
+    MAX_PAGE_SIZE = 100
+
+    # sort name -> (column name, descending)
+    # NB: each sort column needs a composite index on (column, id)
+    SORT_OPTIONS = {
+        'oldest': ('start_date', False),
+        'newest': ('start_date', True),
+    }
+
+    @classmethod
+    def get_eager_load_options(cls):
+        return [joinedload(cls.item).joinedload(Item.seller), joinedload(cls.item).selectinload(Item.media)]
+
+    @classmethod
+    def to_dicts(cls, entities, for_user=None):
+        category_tags = Item.get_category_tags([e.item_id for e in entities])
+        return [e.to_dict(for_user=for_user, category_tags=category_tags[e.item_id]) for e in entities]
+
+    @classmethod
+    def filter_catalog(cls, q, args):
+        price_column = getattr(cls, cls.PRICE_COLUMN)
+        for k in ['price_min', 'price_max']:
+            if k not in args:
+                continue
+            try:
+                price = float(args[k])
+            except ValueError:
+                raise ValidationError(f"{k.replace('_', ' ')} is invalid.".capitalize())
+            q = q.filter(price_column >= price if k == 'price_min' else price_column <= price)
+        if args.get('category'):
+            category_tag = Category.tag_from_str(args['category'])
+            q = q.filter(cls.item_id.in_(db.session.query(ItemCategory.item_id).join(Category).filter(Category.tag == category_tag)))
+        if args.get('seller'):
+            q = q.filter(cls.item_id.in_(db.session.query(Item.id).join(User, Item.seller_id == User.id).filter(User.merchant_public_key == args['seller'])))
+        return q
+
+    @classmethod
+    def encode_cursor(cls, entity, sort_column_name):
+        value = getattr(entity, sort_column_name)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        return base64.urlsafe_b64encode(json.dumps([value, entity.id]).encode('utf-8')).decode('ascii')
+
+    @classmethod
+    def decode_cursor(cls, cursor, sort_column_name):
+        try:
+            value, entity_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            # NB: cursors come from the client, so the values need to be checked before they reach the database
+            column_type = getattr(cls, sort_column_name).type
+            if isinstance(column_type, db.DateTime):
+                value = datetime.fromisoformat(value)
+            elif isinstance(column_type, db.Integer):
+                cls.check_cursor_int(value)
+            elif isinstance(column_type, (db.Float, db.Numeric)):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raise ValueError()
+            elif not (isinstance(column_type, db.String) and isinstance(value, str)):
+                raise ValueError()
+            cls.check_cursor_int(entity_id)
+            return value, entity_id
+        except (ValueError, TypeError, binascii.Error):
+            raise ValidationError("Invalid cursor.")
+
+    @staticmethod
+    def check_cursor_int(value):
+        if isinstance(value, bool) or not isinstance(value, int) or not -2 ** 31 <= value < 2 ** 31:
+            raise ValueError()
+
+    @classmethod
+    def query_page(cls, q, args):
+        """
+        Filter and sort `q` according to the request args.
+        Returns a page of results if `limit` or `cursor` are present, otherwise returns all the results.
+        """
+        sort = args.get('sort', 'oldest')
+        if sort not in cls.SORT_OPTIONS:
+            raise ValidationError(f"Invalid sort. Valid options are: {', '.join(cls.SORT_OPTIONS)}.")
+        sort_column_name, descending = cls.SORT_OPTIONS[sort]
+        sort_column = getattr(cls, sort_column_name)
+
+        q = cls.filter_catalog(q, args)
+        q = q.order_by(sort_column.desc(), cls.id.desc()) if descending else q.order_by(sort_column, cls.id)
+
+        if 'limit' not in args and 'cursor' not in args:
+            return q.all(), None
+
+        try:
+            limit = int(args.get('limit', cls.MAX_PAGE_SIZE))
+        except ValueError:
+            raise ValidationError("Limit is invalid.")
+        if not 0 < limit <= cls.MAX_PAGE_SIZE:
+            raise ValidationError(f"Limit needs to be between 1 and {cls.MAX_PAGE_SIZE}.")
+
+        if args.get('cursor'):
+            key, cursor_key = tuple_(sort_column, cls.id), tuple_(*cls.decode_cursor(args['cursor'], sort_column_name))
+            q = q.filter(key < cursor_key if descending else key > cursor_key)
+
+        entities = q.limit(limit + 1).all()
+        next_cursor = cls.encode_cursor(entities[limit - 1], sort_column_name) if len(entities) > limit else None
+        return entities[:limit], next_cursor
+
 class NostrProductMixin:
     def to_nostr_product(self):
         return {
@@ -426,8 +660,10 @@ class Category(db.Model):
 class Item(db.Model):
     __tablename__ = 'items'
 
+    CACHED_COLLECTIONS = ['auctions', 'listings']
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    seller_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+    seller_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False, index=True)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     title = db.Column(db.String(210), nullable=False)
@@ -447,6 +683,15 @@ class Item(db.Model):
     def category_tags(self):
         return [c.tag for c in Category.query.join(ItemCategory).filter_by(item_id=self.id).all()]
 
+    @classmethod
+    def get_category_tags(cls, item_ids):
+        category_tags = {item_id: [] for item_id in item_ids}
+        if item_ids:
+            q = db.session.query(ItemCategory.item_id, Category.tag).join(Category).filter(ItemCategory.item_id.in_(item_ids)).order_by(ItemCategory.id)
+            for item_id, tag in q:
+                category_tags[item_id].append(tag)
+        return category_tags
+
     @classmethod
     def validate_dict(cls, d):
         validated = {}
@@ -470,16 +715,33 @@ class Item(db.Model):
 class ItemCategory(db.Model):
     __tablename__ = 'item_categories'
 
+    CACHED_COLLECTIONS = ['auctions', 'listings']
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
-    item_id = db.Column(db.Integer, db.ForeignKey(Item.id), nullable=False)
-    category_id = db.Column(db.Integer, db.ForeignKey(Category.id), nullable=False)
+    item_id = db.Column(db.Integer, db.ForeignKey(Item.id), nullable=False, index=True)
+    category_id = db.Column(db.Integer, db.ForeignKey(Category.id), nullable=False, index=True)
 
-class Auction(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
+class Auction(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, CatalogMixin, db.Model):
     __tablename__ = 'auctions'
+    __table_args__ = (
+        db.Index('ix_auctions_start_date_id', 'start_date', 'id'),
+        db.Index('ix_auctions_end_date_id', 'end_date', 'id'),
+        db.Index('ix_auctions_starting_bid_id', 'starting_bid', 'id'),
+    )
 
     REQUIRED_FIELDS = ['title', 'description', 'duration_hours', 'starting_bid', 'reserve_bid', 'extra_shipping_domestic_usd', 'extra_shipping_worldwide_usd']
 
+    SORT_OPTIONS = {
+        **CatalogMixin.SORT_OPTIONS,
+        'ending_soon': ('end_date', False),
+        'price_asc': ('starting_bid', False),
+        'price_desc': ('starting_bid', True),
+    }
+    PRICE_COLUMN = 'starting_bid'
+
+    CACHED_COLLECTIONS = ['auctions']
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     uuid = db.Column(UUID(as_uuid=True), nullable=False, unique=True, index=True, default=uuid.uuid4)
@@ -503,13 +765,17 @@ class Auction(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
     def started(self):
         return self.start_date <= datetime.utcnow() if self.start_date else False
 
-    @property
-    def state(self):
-        if not self.started and not self.ended:
+    STATE_ATTRIBUTES = ['start_date', 'end_date']
+
+    @staticmethod
+    def compute_state(start_date, end_date):
+        started = start_date <= datetime.utcnow() if start_date else False
+        ended = end_date < datetime.utcnow() if end_date else False
+        if not started and not ended:
             return 'new'
-        elif self.started and not self.ended:
+        elif started and not ended:
             return 'active'
-        elif self.ended:
+        elif ended:
             return 'past'
 
     # duration_hours reflects the initial duration,
@@ -542,19 +808,52 @@ class Auction(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
 
     winning_bid_id = db.Column(db.Integer, nullable=True)
 
+    # the highest settled bid, kept up to date by Bid.settle / Auction.accept_bid, so we don't need to go through all the bids to find it
+    top_bid_id = db.Column(db.Integer, nullable=True)
+    top_bid_amount = db.Column(db.Integer, nullable=True)
+
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     bids = db.relationship('Bid', backref='auction', foreign_keys='Bid.auction_id', order_by='desc(Bid.amount)')
+    top_bid = db.relationship('Bid', foreign_keys=[top_bid_id], primaryjoin='Bid.id == Auction.top_bid_id', post_update=True)
 
     def get_top_bid(self, below=None):
-        return max((bid for bid in self.bids if bid.settled_at and (below is None or bid.amount < below)), default=None, key=lambda bid: bid.amount)
+        if below is None:
+            return self.top_bid
+        return Bid.query.filter(Bid.auction_id == self.id, Bid.settled_at != None, Bid.amount < below).order_by(Bid.amount.desc()).first()
+
+    def get_top_bid_update(self, bid):
+        # NB: the amount is compared by the database as part of the UPDATE, which locks the row,
+        # so out of several concurrent bids only the highest one can end up being the top bid
+        return update(Auction) \
+            .where(Auction.id == self.id, (Auction.top_bid_amount == None) | (Auction.top_bid_amount < bid.amount)) \
+            .values(top_bid_id=bid.id, top_bid_amount=bid.amount) \
+            .execution_options(synchronize_session=False)
+
+    def accept_bid(self, bid):
+        """
+        Settle a new bid, making it the top bid and extending the auction if needed, all in one atomic UPDATE.
+        Returns the number of seconds the auction was extended by,
+        or None if the bid was not accepted because the auction is not running or there is a higher bid (possibly placed just now by somebody else).
+        """
+        now = datetime.utcnow()
+        bid.settled_at = now
+        db.session.flush() # so the bid gets an id
+
+        old_end_date = self.end_date
+        end_date = db.session.execute(self.get_top_bid_update(bid)
+            .where(Auction.start_date <= now, Auction.end_date > now)
+            .values(end_date=func.greatest(Auction.end_date, now + timedelta(minutes=app.config['BID_LAST_MINUTE_EXTEND'])))
+            .returning(Auction.end_date)).scalar()
+        db.session.expire(self, ['top_bid', 'top_bid_id', 'top_bid_amount', 'end_date'])
+
+        if end_date is None:
+            return None
+        return max((end_date - old_end_date).total_seconds(), 0)
 
     def get_winning_bid(self):
         return [b for b in self.bids if b.id == self.winning_bid_id][0] if self.winning_bid_id else None
 
-    def sort_key(self):
-        return self.start_date
-
     def get_not_editable_reason(self):
         if len(self.bids) > 0:
             return "Cannot edit auctions that already have bids."
@@ -563,8 +862,7 @@ class Auction(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
     def reserve_bid_reached(self):
         if self.reserve_bid == 0:
             return True
-        top_bid = self.get_top_bid()
-        return top_bid.amount >= self.reserve_bid if top_bid else False
+        return self.top_bid_amount >= self.reserve_bid if self.top_bid_amount is not None else False
 
     @property
     def nostr_event_kind(self):
@@ -577,7 +875,11 @@ class Auction(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
         nostr_product['duration'] = self.duration_hours * 60 * 60
         return nostr_product
 
-    def to_dict(self, for_user=None):
+    @classmethod
+    def get_eager_load_options(cls):
+        return super().get_eager_load_options() + [selectinload(cls.bids).joinedload(Bid.buyer)]
+
+    def to_dict(self, for_user=None, category_tags=None):
         if not self.started:
             ends_in_seconds = None
         elif self.ended:
@@ -591,7 +893,7 @@ class Auction(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
             'key': self.key,
             'title': self.item.title,
             'description': self.item.description,
-            'categories': self.item.category_tags,
+            'categories': category_tags if category_tags is not None else self.item.category_tags,
             'duration_hours': self.duration_hours,
             'skin_in_the_game_required': self.skin_in_the_game_required,
             'verified_identities_required': self.verified_identities_required,
@@ -642,6 +944,26 @@ class Auction(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
         q = (cls.start_date != None) & (cls.start_date <= datetime.utcnow()) & (cls.end_date <= datetime.utcnow())
         return cls.query.filter(q)
 
+    @classmethod
+    def get_next_transition(cls):
+        # the next time an auction starts or ends, which is when the active / inactive auctions change without any write happening
+        now = datetime.utcnow()
+        next_start = db.session.query(func.min(cls.start_date)).filter(cls.start_date > now).scalar()
+        next_end = db.session.query(func.min(cls.end_date)).filter(cls.end_date > now).scalar()
+        return min((d for d in [next_start, next_end] if d), default=None)
+
+    @classmethod
+    def refresh_dict(cls, d):
+        # ends_in_seconds is relative to the current time, so we need to recompute it for dicts that were cached
+        if not d['ends_in_seconds']:
+            return d
+        end_date = dateutil.parser.isoparse(d['end_date']).replace(tzinfo=None)
+        return {**d, 'ends_in_seconds': max((end_date - datetime.utcnow()).total_seconds(), 0)}
+
+    @classmethod
+    def get_payload_refresh(cls, plural):
+        return lambda payload: {**payload, plural: [cls.refresh_dict(d) for d in payload[plural]]}
+
     @classmethod
     def validate_dict(cls, d):
         validated = {}
@@ -683,11 +1005,24 @@ class Auction(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
                 raise ValidationError(f"{k.replace('_', ' ')} is invalid.".capitalize())
         return validated
 
-class Listing(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
+class Listing(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, CatalogMixin, db.Model):
     __tablename__ = 'listings'
+    __table_args__ = (
+        db.Index('ix_listings_start_date_id', 'start_date', 'id'),
+        db.Index('ix_listings_price_usd_id', 'price_usd', 'id'),
+    )
 
     REQUIRED_FIELDS = ['title', 'description', 'price_usd', 'available_quantity', 'extra_shipping_domestic_usd', 'extra_shipping_worldwide_usd']
 
+    SORT_OPTIONS = {
+        **CatalogMixin.SORT_OPTIONS,
+        'price_asc': ('price_usd', False),
+        'price_desc': ('price_usd', True),
+    }
+    PRICE_COLUMN = 'price_usd'
+
+    CACHED_COLLECTIONS = ['listings']
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     uuid = db.Column(UUID(as_uuid=True), nullable=False, unique=True, index=True, default=uuid.uuid4)
@@ -717,11 +1052,13 @@ class Listing(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
         return self.available_quantity == 0
     ##########
 
-    @property
-    def state(self):
-        if not self.nostr_event_id:
+    STATE_ATTRIBUTES = ['nostr_event_id', 'available_quantity']
+
+    @staticmethod
+    def compute_state(nostr_event_id, available_quantity):
+        if not nostr_event_id:
             return 'new'
-        elif self.available_quantity != 0:
+        elif available_quantity != 0:
             return 'active'
         else:
             return 'past'
@@ -735,9 +1072,6 @@ class Listing(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
 
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
-    def sort_key(self):
-        return self.start_date
-
     @property
     def nostr_event_kind(self):
         return 30018
@@ -749,7 +1083,7 @@ class Listing(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
         nostr_product['quantity'] = self.available_quantity
         return nostr_product
 
-    def to_dict(self, for_user=None):
+    def to_dict(self, for_user=None, category_tags=None):
         assert isinstance(for_user, int | None)
 
         listing = {
@@ -760,7 +1094,7 @@ class Listing(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
             'title': self.item.title,
             'description': self.item.description,
             'digital_item_message': self.item.digital_item_message,
-            'categories': self.item.category_tags,
+            'categories': category_tags if category_tags is not None else self.item.category_tags,
             'start_date': self.start_date.isoformat() + "Z" if self.start_date else None,
             'started': self.started,
             'ended': self.ended,
@@ -785,6 +1119,14 @@ class Listing(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
         q = (cls.start_date != None) & (cls.start_date <= datetime.utcnow()) & (cls.available_quantity == 0)
         return cls.query.filter(q)
 
+    @classmethod
+    def get_next_transition(cls):
+        return db.session.query(func.min(cls.start_date)).filter(cls.start_date > datetime.utcnow()).scalar()
+
+    @classmethod
+    def get_payload_refresh(cls, plural):
+        return None
+
     @classmethod
     def validate_dict(cls, d):
         validated = {}
@@ -816,6 +1158,8 @@ class Listing(GeneratedKeyMixin, StateFilterMixin, NostrProductMixin, db.Model):
 class Media(db.Model):
     __tablename__ = 'media'
 
+    CACHED_COLLECTIONS = ['auctions', 'listings']
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     item_id = db.Column(db.Integer, db.ForeignKey(Item.id), nullable=False)
@@ -842,6 +1186,8 @@ class Media(db.Model):
 class Bid(db.Model):
     __tablename__ = 'bids'
 
+    CACHED_COLLECTIONS = ['auctions']
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
     nostr_event_id = db.Column(db.String(64), unique=True, nullable=True, index=True)
@@ -858,6 +1204,17 @@ class Bid(db.Model):
 
     amount = db.Column(db.Integer, nullable=False)
 
+    __table_args__ = (
+        # used to walk down the settled bids of an auction (see Auction.get_top_bid)
+        db.Index('ix_bids_auction_id_amount_settled', auction_id, amount.desc(), postgresql_where=settled_at != None),
+    )
+
+    def settle(self):
+        self.settled_at = datetime.utcnow()
+        db.session.flush()
+        db.session.execute(self.auction.get_top_bid_update(self))
+        db.session.expire(self.auction, ['top_bid', 'top_bid_id', 'top_bid_amount'])
+
     def to_dict(self):
         return {
             'amount': self.amount,
@@ -874,6 +1231,105 @@ class Bid(db.Model):
             'is_winning_bid': self.id == self.auction.winning_bid_id,
         }
 
+class StallStats(db.Model):
+    """
+    Per-user counts of items, auctions and listings, which User.to_dict uses instead of going through all the items of the user.
+    The counts are updated incrementally on every write (see update_stall_stats) and rebuilt from scratch
+    when one of the user's auctions starts or ends (refresh_at) or, just to be safe, at least once every MAX_AGE.
+    NB: rebuilding happens on first use, which means that reads (like GET requests showing a user) can write the stats - this is intended,
+    since the rebuilt stats are saved in a separate short transaction (see rebuild), so the read does not depend on it.
+    """
+    __tablename__ = 'stall_stats'
+
+    MAX_AGE = timedelta(hours=1)
+
+    WRITTEN_USER_IDS = 'stall_stats_written_user_ids' # (in Session.info) the users whose stats the current transaction wrote to
+
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), primary_key=True)
+
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    active_auction_count = db.Column(db.Integer, nullable=False, default=0)
+    past_auction_count = db.Column(db.Integer, nullable=False, default=0)
+    active_listing_count = db.Column(db.Integer, nullable=False, default=0)
+    past_listing_count = db.Column(db.Integer, nullable=False, default=0)
+
+    refresh_at = db.Column(db.DateTime, nullable=False)
+
+    @classmethod
+    def get(cls, user_id):
+        stats = cls.load(user_id)
+        if stats is None or stats.refresh_at < datetime.utcnow():
+            stats = cls.rebuild(user_id)
+        return stats
+
+    @classmethod
+    def load(cls, user_id):
+        # NB: the stats are written using Core statements (see rebuild and update_stall_stats), which bypass the session's identity map,
+        # so an instance already in the session could be stale and we overwrite it with what is in the database
+        return db.session.execute(db.select(cls).filter_by(user_id=user_id).execution_options(populate_existing=True)).scalar_one_or_none()
+
+    @classmethod
+    def rebuild(cls, user_id):
+        """
+        Count everything from scratch and save the result.
+        This is done in a separate transaction, so only committed data is counted and the result is saved regardless of what happens to the current session,
+        unless the current session already wrote to the stats of this user (see update_stall_stats), in which case it holds the lock on the row,
+        so the stats are counted (including the pending changes) and saved in the current transaction instead.
+        """
+        if user_id in db.session.info.get(cls.WRITTEN_USER_IDS, ()):
+            connection = db.session.connection()
+            values = cls.count(connection, user_id)
+            connection.execute(cls.upsert(values))
+            return cls.load(user_id)
+
+        with db.engine.connect() as connection:
+            values = cls.count(connection, user_id)
+            try:
+                # if the row is locked by a pending write of another session, don't wait for it, just don't save
+                connection.execute(db.text("SET LOCAL lock_timeout = '1s'"))
+                connection.execute(cls.upsert(values))
+                connection.commit()
+            except OperationalError:
+                app.logger.warning(f"Could not save stall stats for user id={user_id}.")
+                connection.rollback()
+                return cls(**values) # NB: not saved, so not added to the session either
+
+        return cls.load(user_id)
+
+    @classmethod
+    def count(cls, connection, user_id):
+        now = datetime.utcnow()
+        seller_item_ids = db.select(Item.id).where(Item.seller_id == user_id).scalar_subquery()
+        auction_active = (Auction.start_date <= now) & ((Auction.end_date == None) | (Auction.end_date >= now))
+        listing_active = (Listing.nostr_event_id != None) & ((Listing.available_quantity == None) | (Listing.available_quantity != 0))
+        listing_past = (Listing.nostr_event_id != None) & (Listing.available_quantity == 0)
+
+        item_count = connection.execute(db.select(func.count(Item.id)).where(Item.seller_id == user_id)).scalar()
+        active_auction_count, past_auction_count, next_start, next_end = connection.execute(
+            db.select(
+                func.count(Auction.id).filter(auction_active),
+                func.count(Auction.id).filter(Auction.end_date < now),
+                func.min(Auction.start_date).filter(Auction.start_date > now),
+                func.min(Auction.end_date).filter(Auction.end_date > now))
+            .where(Auction.item_id.in_(seller_item_ids))).one()
+        active_listing_count, past_listing_count = connection.execute(
+            db.select(func.count(Listing.id).filter(listing_active), func.count(Listing.id).filter(listing_past))
+            .where(Listing.item_id.in_(seller_item_ids))).one()
+
+        return {
+            'user_id': user_id,
+            'item_count': item_count,
+            'active_auction_count': active_auction_count,
+            'past_auction_count': past_auction_count,
+            'active_listing_count': active_listing_count,
+            'past_listing_count': past_listing_count,
+            'refresh_at': min(d for d in [next_start, next_end, now + cls.MAX_AGE] if d),
+        }
+
+    @classmethod
+    def upsert(cls, values):
+        return insert(cls).values(**values).on_conflict_do_update(index_elements=[cls.user_id], set_={k: v for k, v in values.items() if k != 'user_id'})
+
 class Order(db.Model):
     """
         Orders come in via Nostr NIP-15.
@@ -1165,3 +1621,77 @@ class LightningPaymentLog(db.Model):
         db.session.commit()
 
         return True
+
+@event.listens_for(db.session, 'before_flush')
+def bump_cached_collection_versions(session, _flush_context, _instances):
+    """
+    Invalidate the cached responses (see cache.py) that depend on the objects being written,
+    by bumping the version of their collections once the transaction commits.
+    """
+    collections = set()
+    for obj in chain(session.new, session.deleted, (obj for obj in session.dirty if session.is_modified(obj))):
+        collections.update(getattr(obj, 'CACHED_COLLECTIONS', []))
+    if collections:
+        State.bump_versions_on_commit(session, collections)
+
+@event.listens_for(db.session, 'after_commit')
+def bump_pending_versions(session):
+    collections = session.info.pop(State.PENDING_VERSION_BUMPS, None)
+    if collections:
+        try:
+            with db.engine.begin() as connection:
+                State.bump_versions(connection, collections)
+        except Exception:
+            # NB: the change itself is committed already, so we don't fail the request - the cached responses will be stale until the next bump
+            app.logger.exception(f"Could not bump the versions of {sorted(collections)}.")
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_pending_versions(session):
+    session.info.pop(State.PENDING_VERSION_BUMPS, None)
+
+# make sure the previous values of the attributes that determine the state of an auction / listing are always loaded when they change,
+# so update_stall_stats can tell which state the entity was in
+for attribute in [Auction.start_date, Auction.end_date, Listing.nostr_event_id, Listing.available_quantity]:
+    event.listen(attribute, 'set', lambda *_: None, active_history=True)
+
+@event.listens_for(db.session, 'before_flush')
+def update_stall_stats(session, _flush_context, _instances):
+    deltas = defaultdict(Counter)
+    refresh_at = {}
+    now = datetime.utcnow()
+    with session.no_autoflush:
+        for obj in chain(session.new, session.dirty, session.deleted):
+            if isinstance(obj, Item):
+                seller_id = obj.seller.id if obj.seller else obj.seller_id
+                if obj in session.new:
+                    deltas[seller_id]['item_count'] += 1
+                elif obj in session.deleted:
+                    deltas[seller_id]['item_count'] -= 1
+            elif isinstance(obj, (Auction, Listing)):
+                old_state = obj.get_committed_state() if obj not in session.new else None
+                new_state = obj.state if obj not in session.deleted else None
+                seller_id = obj.get_seller_id()
+                singular = obj.__tablename__[:-1]
+                if old_state != new_state:
+                    if old_state in ('active', 'past'):
+                        deltas[seller_id][f'{old_state}_{singular}_count'] -= 1
+                    if new_state in ('active', 'past'):
+                        deltas[seller_id][f'{new_state}_{singular}_count'] += 1
+                if isinstance(obj, Auction) and new_state:
+                    transitions = [d for d in [obj.start_date, obj.end_date] if d and d > now]
+                    if transitions:
+                        refresh_at[seller_id] = min(transitions)
+
+    for user_id in set(deltas) | set(refresh_at):
+        # NB: if there is no row yet, there is nothing to update - it will get built from scratch on first use
+        values = {k: getattr(StallStats, k) + v for k, v in deltas[user_id].items() if v}
+        if user_id in refresh_at:
+            values['refresh_at'] = func.least(StallStats.refresh_at, refresh_at[user_id])
+        if values:
+            session.connection().execute(update(StallStats).where(StallStats.user_id == user_id).values(**values))
+            session.info.setdefault(StallStats.WRITTEN_USER_IDS, set()).add(user_id)
+
+@event.listens_for(db.session, 'after_transaction_end')
+def forget_stall_stats_written(session, transaction):
+    if transaction.parent is None: # NB: the locks are only released when the outermost transaction ends
+        session.info.pop(StallStats.WRITTEN_USER_IDS, None)
@@ -8,6 +8,7 @@ from arsenic.services import Geckodriver
 import asyncio
 import bech32
 from bs4 import BeautifulSoup
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
 from enum import IntEnum
 import json
@@ -15,10 +16,13 @@ import logging
 from logging.config import dictConfig
 import os
 import os.path
+import random
 import requests
+import sqlite3
 import sys
 import time
 import websockets
+import zlib
 from websockets.exceptions import ConnectionClosedOK
 
 BIRDWATCHER_PORT = 6000
@@ -28,12 +32,75 @@ ENV = os.environ.get('ENV')
 API_BASE_URL = os.environ.get('API_BASE_URL')
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
 LOG_FILENAME = os.environ.get('LOG_FILENAME', "pm.log")
-PROCESSED_EVENT_IDS_FILENAME = os.environ.get('PROCESSED_EVENT_IDS_FILENAME')
+PROCESSED_EVENT_IDS_FILENAME = os.environ.get('PROCESSED_EVENT_IDS_FILENAME') # NB: legacy text file, only used to import the IDs into PROCESSED_EVENTS_DB_FILENAME
+# NB: installs that only have the legacy file configured get the database next to it, so they keep their processed events (and relay cursors) across restarts
+PROCESSED_EVENTS_DB_FILENAME = os.environ.get('PROCESSED_EVENTS_DB_FILENAME') or \
+    (os.path.join(os.path.dirname(PROCESSED_EVENT_IDS_FILENAME), "processed_events.sqlite") if PROCESSED_EVENT_IDS_FILENAME else None)
+PROCESSED_EVENTS_MAX_AGE = timedelta(days=int(os.environ.get('PROCESSED_EVENTS_MAX_AGE_DAYS', 90)))
 VERIFIED_EXTERNAL_IDENTITIES_FILENAME = os.environ.get('VERIFIED_EXTERNAL_IDENTITIES_FILENAME')
 GECKODRIVER_BINARY = os.environ.get('GECKODRIVER_BINARY')
 
+# events are forwarded to all relays, but we only wait until this many of them acknowledged the event (NIP-20) or until the timeout
+# NB: we don't retry events that did not reach the quorum, we just report it and leave retrying to the caller (the API's outbox)
+PUBLISH_QUORUM = int(os.environ.get('PUBLISH_QUORUM', 2))
+PUBLISH_TIMEOUT = float(os.environ.get('PUBLISH_TIMEOUT', 5))
+
+# queries go to the QUERY_FANOUT relays that answered fastest in the past (plus one random other relay, so slow relays get a chance to recover),
+# and return as soon as QUERY_QUORUM of them finished answering (EOSE) or after QUERY_TIMEOUT seconds
+QUERY_FANOUT = int(os.environ.get('QUERY_FANOUT', 5))
+QUERY_QUORUM = int(os.environ.get('QUERY_QUORUM', 2))
+QUERY_TIMEOUT = float(os.environ.get('QUERY_TIMEOUT', 1))
+
+# identical queries are only sent to the relays once while in flight, and their results are cached for QUERY_CACHE_TTL seconds
+QUERY_CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', 10))
+QUERY_CACHE_MAX_ENTRIES = 10000
+
+# events are processed by EVENT_WORKERS workers, each with its own queue of at most EVENT_QUEUE_SIZE events, partitioned by merchant / auction,
+# so events of the same merchant / auction are processed in order, and relays are not read from while the queue they need is full
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', 8))
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 1000))
+
+# events we could not process (for example because the API was not available) are queued again after EVENT_RETRY_DELAY seconds,
+# doubling the delay after each attempt, up to EVENT_MAX_RETRY_DELAY
+EVENT_RETRY_DELAY = 5
+EVENT_MAX_RETRY_DELAY = 300
+
+# when resubscribing after reconnecting, we only ask for events created since the latest one we got (minus this margin, in seconds,
+# since the clocks of the clients that create the events are not in sync), but never since after the oldest event we did not process yet,
+# so events that are still queued or that the API could not take (yet) are sent again after reconnecting or restarting
+RESUBSCRIBE_SINCE_MARGIN = 600
+CURSOR_SAVE_INTERVAL = 1
+
+# auctions are unsubscribed from once they ended (including the extensions we know of from bid statuses) at least this long ago,
+# which also covers extensions we might not know of
+AUCTION_EVICTION_GRACE = timedelta(hours=1)
+AUCTION_EVICTION_INTERVAL = 60
+
+# the merchants we subscribe to DMs of and the auctions we subscribe to bids of are split into SUBSCRIPTION_SHARDS subscriptions each
+# (by a stable hash of the key, so a new key only changes one subscription), with at most SUBSCRIPTION_FILTER_MAX_KEYS keys per filter,
+# to stay within the limits of relays (strfry, for example, defaults to maxSubsPerConnection = 100)
+# NB: unless --discover-all is used, the stalls and auctions we discover are also only those of our merchants, sharded the same way as their DMs
+SUBSCRIPTION_SHARDS = int(os.environ.get('SUBSCRIPTION_SHARDS', 16))
+SUBSCRIPTION_FILTER_MAX_KEYS = int(os.environ.get('SUBSCRIPTION_FILTER_MAX_KEYS', 250))
+
+# all requests to the API go through one session, so connections are kept alive and reused (at most API_MAX_CONNECTIONS at a time)
+API_MAX_CONNECTIONS = int(os.environ.get('API_MAX_CONNECTIONS', 20))
+API_KEEPALIVE_TIMEOUT = 60
+API_TIMEOUT = float(os.environ.get('API_TIMEOUT', 60))
+
+# DMs and bids that are waiting in the same queue are forwarded to the API together (in order), at most FORWARD_BATCH_SIZE at a time,
+# so catching up after a reconnect doesn't take a request per event (NB: the API accepts at most EVENTS_BATCH_MAX_SIZE
+# and only processes events for EVENTS_BATCH_MAX_SECONDS, answering 503 for the rest, which we retry)
+FORWARD_BATCH_SIZE = int(os.environ.get('FORWARD_BATCH_SIZE', 10))
+
+# the merchants of this site are kept in memory, refreshed every MERCHANTS_REFRESH_INTERVAL seconds (revalidating the ETag of /api/merchants),
+# and pubkeys the API said are *not* our merchants are remembered for FOREIGN_PUBKEYS_CACHE_TTL seconds, so only unknown pubkeys hit the API
+MERCHANTS_REFRESH_INTERVAL = int(os.environ.get('MERCHANTS_REFRESH_INTERVAL', 30))
+FOREIGN_PUBKEYS_CACHE_TTL = int(os.environ.get('FOREIGN_PUBKEYS_CACHE_TTL', 600))
+FOREIGN_PUBKEYS_CACHE_MAX_ENTRIES = 100000
+
 PERMANENT_API_ERROR_STATI = [400, 403, 404]
-RECOVERABLE_API_ERROR_STATI = [500]
+RECOVERABLE_API_ERROR_STATI = [500, 503]
 
 dictConfig({
     'version': 1,
@@ -56,6 +123,19 @@ dictConfig({
     'root': {'level': LOG_LEVEL, 'handlers': ['default', 'info_rotating_file_handler']},
 })
 
+def matches_filters(event, filters):
+    for key, values in filters.items():
+        if key == 'kinds' and event['kind'] not in values:
+            return False
+        if key == 'authors' and event['pubkey'] not in values:
+            return False
+        if key.startswith('#') and not any(tag[0] == key[1:] and tag[1] in values for tag in event['tags'] if len(tag) > 1):
+            return False
+    return True
+
+def get_shard(key):
+    return zlib.crc32(key.encode()) % SUBSCRIPTION_SHARDS
+
 def pk2npub(pk):
     return bech32.bech32_encode('npub', bech32.convertbits(bytes.fromhex(pk), 8, 5))
 
@@ -66,153 +146,545 @@ class EventKind(IntEnum):
     STALL = 30017
     AUCTION = 30020
     BID = 1021
+    BID_STATUS = 1022
+
+# the kinds of events we keep cursors for (see Relay.last_created_at)
+CURSOR_EVENT_KINDS = (EventKind.DM, EventKind.BID, EventKind.AUCTION, EventKind.STALL)
+
+class ProcessedEventStore:
+    """
+    The IDs of the events we already processed, so we don't POST them to the API again when relays send them again.
+    They are kept in SQLite, so neither startup time nor memory depend on how many events we processed over time.
+    New IDs are only kept in memory until the next (batched) `flush` and IDs older than PROCESSED_EVENTS_MAX_AGE are removed by `compact`
+    (so DMs and bids created before then are never processed again - see EventDispatcher.dispatch).
+
+    Also keeps a cursor for each relay and kind of events (see Relay.last_created_at), so we can resubscribe from there after restarting.
+    """
+
+    FLUSH_INTERVAL = 1
+    COMPACT_INTERVAL = 3600
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename or ":memory:")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS processed_events (id TEXT PRIMARY KEY, processed_at INTEGER NOT NULL) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS ix_processed_events_processed_at ON processed_events (processed_at)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS relay_cursors (relay_url TEXT, kind INTEGER, created_at INTEGER NOT NULL, PRIMARY KEY (relay_url, kind)) WITHOUT ROWID")
+        self.pending = {} # event ID => processed at
+        self.pending_cursors = {} # (relay URL, kind) => created at
+
+    def __contains__(self, event_id):
+        return event_id in self.pending or self.db.execute("SELECT 1 FROM processed_events WHERE id = ?", (event_id,)).fetchone() is not None
+
+    def add(self, event_id):
+        self.pending[event_id] = int(time.time())
+
+    def get_cursors(self, relay_url):
+        return {EventKind(kind): created_at for kind, created_at in self.db.execute("SELECT kind, created_at FROM relay_cursors WHERE relay_url = ?", (relay_url,))}
+
+    def set_cursor(self, relay_url, kind, created_at):
+        self.pending_cursors[(relay_url, kind)] = created_at
+
+    def import_file(self, filename):
+        with open(filename, 'r') as f:
+            for line in f:
+                if line.strip():
+                    self.add(line.strip())
+        count = len(self.pending)
+        self.flush()
+        return count
+
+    def flush(self):
+        if self.pending:
+            with self.db:
+                self.db.executemany("INSERT OR IGNORE INTO processed_events (id, processed_at) VALUES (?, ?)", self.pending.items())
+            self.pending.clear()
+        if self.pending_cursors:
+            with self.db:
+                # NB: cursors can also move back, when we get older events (of merchants or auctions we just subscribed to) that we did not process yet
+                self.db.executemany("INSERT INTO relay_cursors (relay_url, kind, created_at) VALUES (?, ?, ?) ON CONFLICT (relay_url, kind) DO UPDATE SET created_at = excluded.created_at",
+                    [(relay_url, kind, created_at) for (relay_url, kind), created_at in self.pending_cursors.items()])
+            self.pending_cursors.clear()
+
+    def compact(self):
+        with self.db:
+            return self.db.execute("DELETE FROM processed_events WHERE processed_at < ?", (int(time.time() - PROCESSED_EVENTS_MAX_AGE.total_seconds()),)).rowcount
+
+    async def maintain(self):
+        compacted_at = 0
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            try:
+                self.flush()
+                if time.monotonic() - compacted_at > self.COMPACT_INTERVAL:
+                    logging.info(f"Compacted processed events: {self.compact()} removed.")
+                    compacted_at = time.monotonic()
+            except Exception:
+                logging.exception("Error saving processed events!")
+
+class EventDispatcher:
+    """
+    Receives the events from all relays and dedupes them by ID as soon as they arrive, so each event is only queued and processed once,
+    no matter how many relays send it. Also keeps track of how long after the first relay each of the other relays sends the same event.
+    """
+
+    SEEN_MAX_ENTRIES = 100000
+
+    def __init__(self, relays, processed_event_ids):
+        self.relays = relays
+        self.processed_event_ids = processed_event_ids
+
+        self.seen: OrderedDict[str, float] = OrderedDict() # event ID => when we first got it
+        self.unprocessed: dict[str, tuple[EventKind, int]] = {} # event ID => (kind, created at) of the events queued or waiting to be retried, which hold back the relay cursors
+        self.queues = [asyncio.queues.Queue(maxsize=EVENT_QUEUE_SIZE) for _ in range(EVENT_WORKERS)] # (relay that sent the event first, event)
+        self.retries: dict[str, tuple[float, Relay, dict]] = {} # event ID => (when to queue it again, relay, event)
+        self.retry_attempts: dict[str, int] = {} # event ID => how many times we tried to process it
+
+        # what we subscribed to on all relays, so relays that (re)connect later can subscribe to the same
+        self.merchant_pubkeys = set()
+        self.auction_owners = {} # event ID to pubkey
+
+        self.auction_end_dates: dict[str, datetime] = {} # event ID to the end date in the auction event
+        self.merchants_etag = None # of the last response of /api/merchants we got, so we only get the merchants again if they changed
+        self.foreign_pubkeys: OrderedDict[str, float] = OrderedDict() # pubkeys that are not our merchants => when we should ask the API again
+        self.api_session = None
+        self.auction_extensions: dict[str, dict[str, int]] = {} # event ID to the durations (in seconds) the auction was extended by, by bid status event ID
+
+    @staticmethod
+    def get_partition_key(event):
+        # the merchant for DMs, the auction for bids and the author for anything else
+        tag_name = {EventKind.DM: 'p', EventKind.BID: 'e'}.get(event['kind'])
+        values = [t[1] for t in event['tags'] if len(t) > 1 and t[0] == tag_name]
+        return values[0] if values else event['pubkey']
+
+    async def dispatch(self, relay, event):
+        now = time.monotonic()
+        first_seen_at = self.seen.get(event['id'])
+        if first_seen_at is not None:
+            relay.record_event_lag(now - first_seen_at)
+            return
+        self.seen[event['id']] = now
+        while len(self.seen) > self.SEEN_MAX_ENTRIES:
+            self.seen.popitem(last=False)
+        relay.first_seen_count += 1
+
+        if event['kind'] in (EventKind.DM, EventKind.BID) and event['created_at'] < time.time() - PROCESSED_EVENTS_MAX_AGE.total_seconds():
+            # NB: we might have processed it, but forgot (see ProcessedEventStore.compact), since it was created before we would remember it
+            logging.debug(f"({relay.url}) Skipping event older than {PROCESSED_EVENTS_MAX_AGE}: {event['id']}!")
+        elif event['id'] in self.processed_event_ids:
+            logging.info(f"({relay.url}) Skipping event already processed: {event['id']}!")
+        elif event['id'] in self.unprocessed:
+            logging.info(f"({relay.url}) Skipping event already queued or waiting to be retried: {event['id']}!")
+        else:
+            logging.info(f"({relay.url}) Got EVENT {event}. Adding to queue...")
+            if event['kind'] in CURSOR_EVENT_KINDS:
+                self.unprocessed[event['id']] = (event['kind'], event['created_at'])
+            await self.queue(relay, event)
+
+    async def queue(self, relay, event):
+        queue = self.queues[hash(self.get_partition_key(event)) % len(self.queues)]
+        await queue.put((relay, event)) # NB: if the queue is full, this stops us from reading from the relay until there is room
+
+    def processed(self, event_id):
+        self.unprocessed.pop(event_id, None)
+        self.retry_attempts.pop(event_id, None)
+
+    def retry_later(self, relay, event):
+        # NB: relays only send events again when we resubscribe, so we can't count on them for retrying
+        attempts = self.retry_attempts.get(event['id'], 0) + 1
+        self.retry_attempts[event['id']] = attempts
+        delay = min(EVENT_RETRY_DELAY * 2 ** (attempts - 1), EVENT_MAX_RETRY_DELAY)
+        logging.info(f"Retrying event {event['id']} in {delay} seconds...")
+        self.retries[event['id']] = (time.monotonic() + delay, relay, event)
+
+    async def retry_events(self):
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for event_id, (retry_at, relay, event) in list(self.retries.items()):
+                if retry_at <= now:
+                    del self.retries[event_id]
+                    await self.queue(relay, event)
+
+    async def process_events(self, queue):
+        while True:
+            relay, event = await queue.get()
+            if event['kind'] not in (EventKind.DM, EventKind.BID):
+                await self.process_event(relay, event)
+                continue
+            batch, next_event = [(relay, event)], None
+            while len(batch) < FORWARD_BATCH_SIZE and not queue.empty():
+                relay, event = queue.get_nowait()
+                if event['kind'] in (EventKind.DM, EventKind.BID):
+                    batch.append((relay, event))
+                else:
+                    next_event = (relay, event)
+                    break
+            await self.forward_events(batch)
+            if next_event is not None:
+                await self.process_event(*next_event)
+
+    async def process_event(self, relay, event):
+        logging.info(f"({relay.url}) Processing event {event['id']}...")
+        try:
+            await relay.process_event(event)
+        except Exception:
+            logging.exception(f"({relay.url}) Error processing event {event['id']}!")
+            self.retry_later(relay, event)
+            return
+        self.processed(event['id'])
+
+    async def forward_events(self, batch):
+        forwarded = []
+        for relay, event in batch:
+            forward = relay.get_forward(event)
+            if forward is not None:
+                forwarded.append(forward)
+            else:
+                self.processed(event['id'])
+        results = []
+        if forwarded:
+            logging.info(f"POSTing {len(forwarded)} events to API: {[f['event']['id'] for f in forwarded]}")
+            try:
+                async with self.get_api_session().post(f"{API_BASE_URL}/api/events/batch", json={'events': forwarded}) as response:
+                    if response.status == 200:
+                        results = (await response.json())['results']
+                    else:
+                        logging.error(f"Error posting {len(forwarded)} events to API: {response.status}.")
+            except Exception:
+                logging.exception(f"Error posting {len(forwarded)} events to API!")
+        for forward, result in zip(forwarded, results):
+            log_forward_result(forward, result)
+            if result['status'] not in RECOVERABLE_API_ERROR_STATI:
+                self.processed_event_ids.add(forward['event']['id'])
+                self.processed(forward['event']['id'])
+        for relay, event in batch:
+            if event['id'] in self.unprocessed:
+                # NB: the API could not take the event (yet)
+                self.retry_later(relay, event)
+
+    def get_low_water_marks(self):
+        # the oldest event of each kind that we did not process yet
+        low_water_marks = {}
+        for kind, created_at in self.unprocessed.values():
+            if created_at < low_water_marks.get(kind, created_at + 1):
+                low_water_marks[kind] = created_at
+        return low_water_marks
+
+    async def save_cursors(self):
+        while True:
+            await asyncio.sleep(CURSOR_SAVE_INTERVAL)
+            low_water_marks = self.get_low_water_marks()
+            for relay in list(self.relays):
+                for kind in relay.last_created_at:
+                    self.processed_event_ids.set_cursor(relay.url, kind, relay.get_cursor(kind, low_water_marks))
+
+    async def subscribe_dm(self, pubkey, **_):
+        await self.subscribe_dm_all([pubkey])
+
+    async def subscribe_dm_all(self, pubkeys):
+        self.merchant_pubkeys.update(pubkeys)
+        for pubkey in pubkeys:
+            self.foreign_pubkeys.pop(pubkey, None)
+        for relay in list(self.relays):
+            if relay.ws is not None:
+                await relay.subscribe_dm_all(pubkeys)
+
+    async def subscribe_bids(self, pubkey, id, end_date=None, **_):
+        self.auction_owners[id] = pubkey
+        if end_date is not None:
+            self.auction_end_dates[id] = end_date
+        for relay in list(self.relays):
+            if relay.ws is not None:
+                await relay.subscribe_bids(pubkey, id)
+
+    def get_api_session(self):
+        # NB: created lazily, since the session needs to be created inside the event loop
+        if self.api_session is None:
+            self.api_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=API_MAX_CONNECTIONS, keepalive_timeout=API_KEEPALIVE_TIMEOUT),
+                timeout=aiohttp.ClientTimeout(total=API_TIMEOUT))
+        return self.api_session
+
+    async def refresh_merchants(self):
+        headers = {'If-None-Match': self.merchants_etag} if self.merchants_etag else {}
+        async with self.get_api_session().get(f"{API_BASE_URL}/api/merchants", headers=headers) as response:
+            if response.status == 304:
+                return
+            if response.status != 200:
+                logging.error(f"Error getting merchants from the API: {response.status}!")
+                return
+            merchant_pubkeys = {m['public_key'] for m in await response.json()}
+            self.merchants_etag = response.headers.get('ETag')
+        # NB: merchants that are gone from the API are not unsubscribed from, since they might still get DMs about older orders
+        new_merchant_pubkeys = merchant_pubkeys - self.merchant_pubkeys
+        if new_merchant_pubkeys:
+            logging.info(f"Got {len(new_merchant_pubkeys)} new merchants from the API!")
+            await self.subscribe_dm_all(new_merchant_pubkeys)
+
+    async def watch_merchants(self):
+        while True:
+            try:
+                await self.refresh_merchants()
+            except Exception:
+                logging.exception("Error refreshing merchants!")
+            await asyncio.sleep(MERCHANTS_REFRESH_INTERVAL)
+
+    async def is_our_merchant(self, pubkey):
+        if pubkey in self.merchant_pubkeys:
+            return True
+        expires_at = self.foreign_pubkeys.get(pubkey)
+        if expires_at is not None and expires_at > time.monotonic():
+            return False
+        async with self.get_api_session().get(f"{API_BASE_URL}/api/merchants/{pubkey}") as response:
+            if response.status == 200:
+                return True
+            if response.status == 404:
+                logging.debug(f"Not our merchant {pubkey}...")
+                self.foreign_pubkeys[pubkey] = time.monotonic() + FOREIGN_PUBKEYS_CACHE_TTL
+                self.foreign_pubkeys.move_to_end(pubkey)
+                while len(self.foreign_pubkeys) > FOREIGN_PUBKEYS_CACHE_MAX_ENTRIES:
+                    self.foreign_pubkeys.popitem(last=False)
+            return False
+
+    def track_bid_status(self, event):
+        # NB: bid statuses (published by the API through us) tell us when auctions get extended by bids placed in the last minutes
+        auction_event_ids = [t[1] for t in event['tags'] if len(t) > 1 and t[0] == 'e']
+        try:
+            duration_extended = json.loads(event['content']).get('duration_extended')
+        except Exception:
+            return
+        if auction_event_ids and auction_event_ids[0] in self.auction_end_dates and duration_extended:
+            # NB: keyed by event ID, since the same bid status could be forwarded more than once
+            self.auction_extensions.setdefault(auction_event_ids[0], {})[event['id']] = duration_extended
+
+    def get_auction_end_date(self, auction_event_id):
+        return self.auction_end_dates[auction_event_id] + timedelta(seconds=sum(self.auction_extensions.get(auction_event_id, {}).values()))
+
+    async def evict_ended_auctions(self):
+        while True:
+            await asyncio.sleep(AUCTION_EVICTION_INTERVAL)
+            ended_auction_event_ids = {id for id in self.auction_end_dates if self.get_auction_end_date(id) + AUCTION_EVICTION_GRACE < datetime.utcnow()}
+            if not ended_auction_event_ids:
+                continue
+            logging.info(f"Unsubscribing from bids of {len(ended_auction_event_ids)} ended auctions...")
+            for id in ended_auction_event_ids:
+                del self.auction_owners[id]
+                del self.auction_end_dates[id]
+                self.auction_extensions.pop(id, None)
+            for relay in list(self.relays):
+                try:
+                    await relay.unsubscribe_bids(ended_auction_event_ids)
+                except Exception:
+                    logging.exception(f"({relay.url}) Error unsubscribing from bids of ended auctions!")
 
 class Relay:
-    def __init__(self, url, args, processed_event_ids, event_ids_being_processed):
+    def __init__(self, url, args, dispatcher):
         self.url = url
         self.args = args
-        self.processed_event_ids = processed_event_ids
-        self.event_ids_being_processed = event_ids_being_processed
+        self.dispatcher = dispatcher
 
         self.ws = None
 
-        self.events_to_process = asyncio.queues.Queue()
+        self.first_seen_count = 0 # how many events we got from this relay before we got them from any other relay
+        self.event_lag = None # moving average of how long after the first relay this relay sent us the same events, in seconds
 
         self.subscribed_auction_event_ids = set()
         self.subscribed_merchant_pubkeys = set()
 
-        self.bid_subscription_id = None
-        self.dm_subscription_id = None
+        self.subscription_ids: dict[tuple[EventKind, int], str] = {} # (kind, shard) => subscription made since the last (re)connect
+        self.last_created_at: dict[EventKind, int] = dispatcher.processed_event_ids.get_cursors(url) # the latest event of each kind we got, so we can resubscribe from there
+        self.full_subscriptions: dict[str, tuple[EventKind, int]] = {} # subscriptions for *all* events of a kind that did not reach EOSE yet => (kind, when they started)
 
         self.auction_owners = {} # event ID to pubkey
 
         self.active_queries: dict[str, asyncio.Event] = {}
         self.query_results: dict[str, list[dict]] = {}
+        self.query_started_at: dict[str, float] = {}
+        self.query_latency = None # moving average of the time it took the relay to answer queries, in seconds
+
+        self.pending_oks: dict[str, asyncio.Future] = {} # event ID to the future that gets the (accepted, message) from the relay's OK
 
     async def check_ours(self, event, subscribe_cb):
-        async def do_get(session, url):
-            async with session.get(url) as response:
-                if response.status == 404:
-                    logging.debug(f"Not our merchant {event['pubkey']}...")
-                elif response.status == 200:
-                    await subscribe_cb(**event)
-        async with aiohttp.ClientSession() as session:
-            await asyncio.create_task(do_get(session, f"{API_BASE_URL}/api/merchants/{event['pubkey']}"))
-
-    async def get_our_merchants(self, subscribe_cb):
-        async def do_get(session, url):
-            async with session.get(url) as response:
-                merchants_response = await response.json()
-                merchant_pks = [m['public_key'] for m in merchants_response]
-                await subscribe_cb(merchant_pks)
-        async with aiohttp.ClientSession() as session:
-            await asyncio.create_task(do_get(session, f"{API_BASE_URL}/api/merchants"))
-
-    async def post_dm(self, merchant_pubkey, dm_event):
-        async def do_post(session, url, json):
-            async with session.post(url, json=json) as response:
-                logging.debug(f"POST to merchant {merchant_pubkey}: {dm_event}")
-                response_json = None
-                try:
-                    response_json = await response.json()
-                    logging.debug(f"POST responded with {response_json}!")
-                except Exception:
-                    response_text = await response.text()
-                    logging.debug(f"POST responded with {response_text}!")
-                if response.status == 200:
-                    logging.info(f"Forwarded message to merchant {merchant_pubkey}.")
-                elif response.status == 409:
-                    logging.info(f"Order already exists at {merchant_pubkey}.")
-                elif response.status in PERMANENT_API_ERROR_STATI or response.status in RECOVERABLE_API_ERROR_STATI:
-                    logging.error(f"Error posting to merchant {merchant_pubkey}: {response.status}; message={response_json.get('message') if response_json else None}.")
-                else:
-                    logging.error(f"Unknown status when posting to merchant {merchant_pubkey}: {response.status}.")
-                return response.status
-        async with aiohttp.ClientSession() as session:
-            task = asyncio.create_task(do_post(session, f"{API_BASE_URL}/api/merchants/{merchant_pubkey}/messages", dm_event))
-            await task
-            return task.result()
-
-    async def post_bid(self, auction_event_id, bid_event):
-        merchant_pubkey = self.auction_owners[auction_event_id]
-        async def do_post(session, url, json):
-            async with session.post(url, json=json) as response:
-                logging.debug(f"POST to auction {auction_event_id} of merchant {merchant_pubkey}: {bid_event}")
-                if response.status == 200:
-                    logging.info(f"Forwarded bid to auction {auction_event_id} of merchant {merchant_pubkey}.")
-                elif response.status in PERMANENT_API_ERROR_STATI or response.status in RECOVERABLE_API_ERROR_STATI:
-                    logging.error(f"Error posting bid to auction {auction_event_id} of merchant {merchant_pubkey}: {response.status}.")
-                else:
-                    logging.error(f"Unknown status when posting bid to auction {auction_event_id} of merchant {merchant_pubkey}: {response.status}.")
-                try:
-                    response_json = await response.json()
-                    logging.debug(f"POST responded with {response_json}!")
-                except Exception:
-                    response_text = await response.text()
-                    logging.debug(f"POST responded with {response_text}!")
-                return response.status
-        async with aiohttp.ClientSession() as session:
-            task = asyncio.create_task(do_post(session, f"{API_BASE_URL}/api/merchants/{merchant_pubkey}/auctions/{auction_event_id}/bids", bid_event))
-            await task
-            return task.result()
+        if await self.dispatcher.is_our_merchant(event['pubkey']):
+            await subscribe_cb(**event)
+
+    def get_forward(self, event):
+        # what we POST to the API for a DM or bid, as part of a batch
+        if event['kind'] == EventKind.DM:
+            return {'merchant_public_key': [t for t in event['tags'] if t[0] == 'p'][0][1], 'event': event}
+        auction_event_id = [t for t in event['tags'] if t[0] == 'e'][0][1]
+        if auction_event_id not in self.auction_owners:
+            logging.info(f"({self.url}) Skipping bid for an auction we are not subscribed to (anymore): {event['id']}!")
+            return None
+        return {'merchant_public_key': self.auction_owners[auction_event_id], 'auction_event_id': auction_event_id, 'event': event}
+
+    def advance_cursor(self, kind, created_at):
+        # NB: the cursor is only saved by EventDispatcher.save_cursors, held back by the events we did not process yet
+        if created_at > self.last_created_at.get(kind, 0):
+            self.last_created_at[kind] = created_at
+
+    def get_cursor(self, kind, low_water_marks=None):
+        if kind not in self.last_created_at:
+            return None
+        if low_water_marks is None:
+            low_water_marks = self.dispatcher.get_low_water_marks()
+        return min(self.last_created_at[kind], low_water_marks.get(kind, self.last_created_at[kind]))
+
+    def get_since(self, kind):
+        cursor = self.get_cursor(kind)
+        return {'since': cursor - RESUBSCRIBE_SINCE_MARGIN} if cursor is not None else {}
+
+    async def subscribe(self, kind, filters, shard=0):
+        # NB: once the relay sent us all the stored events of this subscription (EOSE), we know we are up to date as of when we subscribed,
+        # even if the relay had no new events for us
+        started_at = int(time.time())
+        subscription_id = os.urandom(10).hex()
+        old_subscription_id = self.subscription_ids.get((kind, shard))
+        if old_subscription_id is not None:
+            self.full_subscriptions.pop(old_subscription_id, None)
+            await self.ws.send(json.dumps(['CLOSE', old_subscription_id]))
+        self.subscription_ids[(kind, shard)] = subscription_id
+        self.full_subscriptions[subscription_id] = (kind, started_at)
+        await self.ws.send(json.dumps(['REQ', subscription_id, *[{**f, 'kinds': [kind]} for f in filters]]))
+        return subscription_id
 
     async def subscribe_stall(self):
         logging.info(f"({self.url}) Subscribing for stall events...")
-        subscription_id = os.urandom(10).hex()
-        await self.ws.send(json.dumps(['REQ', subscription_id, {'kinds': [EventKind.STALL]}]))
-        return subscription_id
+        return await self.subscribe(EventKind.STALL, [self.get_since(EventKind.STALL)])
 
     async def subscribe_auction(self):
         logging.info(f"({self.url}) Subscribing for auction events...")
-        subscription_id = os.urandom(10).hex()
-        await self.ws.send(json.dumps(['REQ', subscription_id, {'kinds': [EventKind.AUCTION]}]))
-        return subscription_id
+        return await self.subscribe(EventKind.AUCTION, [self.get_since(EventKind.AUCTION)])
+
+    async def subscribe_shard(self, kind, shard, new_keys=frozenset()):
+        # (re)subscribes to one shard of the DMs, stalls or auctions (by merchant) or bids (by auction), replacing the previous subscription for the shard, if any:
+        # keys we were already subscribed to are only queried since the cursor, but the new keys from the beginning
+        tag, keys = {
+            EventKind.DM: ('#p', self.subscribed_merchant_pubkeys),
+            EventKind.STALL: ('authors', self.subscribed_merchant_pubkeys),
+            EventKind.AUCTION: ('authors', self.subscribed_merchant_pubkeys),
+            EventKind.BID: ('#e', self.subscribed_auction_event_ids),
+        }[kind]
+        shard_keys = [key for key in keys if get_shard(key) == shard]
+        if not shard_keys:
+            subscription_id = self.subscription_ids.pop((kind, shard), None)
+            if subscription_id is not None:
+                self.full_subscriptions.pop(subscription_id, None)
+                await self.ws.send(json.dumps(['CLOSE', subscription_id]))
+            return
+        filters = []
+        for filter_keys, since in [([k for k in shard_keys if k not in new_keys], self.get_since(kind)), ([k for k in shard_keys if k in new_keys], {})]:
+            for i in range(0, len(filter_keys), SUBSCRIPTION_FILTER_MAX_KEYS):
+                filters.append({tag: filter_keys[i:i + SUBSCRIPTION_FILTER_MAX_KEYS], **since})
+        return await self.subscribe(kind, filters, shard)
+
+    def get_merchant_event_kinds(self):
+        # the kinds of events we subscribe to by merchant
+        if self.args.discover and not self.args.discover_all:
+            return [EventKind.DM, EventKind.STALL, EventKind.AUCTION]
+        else:
+            return [EventKind.DM]
 
     async def subscribe_dm(self, pubkey, **_):
-        if pubkey not in self.subscribed_merchant_pubkeys:
-            if self.dm_subscription_id is not None:
-                logging.info(f"({self.url}) Closing subscription for DMs of {len(self.subscribed_merchant_pubkeys)} merchants: {self.dm_subscription_id}...")
-                await self.ws.send(json.dumps(['CLOSE', self.dm_subscription_id]))
-            self.subscribed_merchant_pubkeys.add(pubkey)
-            self.dm_subscription_id = os.urandom(10).hex()
-            logging.info(f"({self.url}) Subscribing to DMs of {len(self.subscribed_merchant_pubkeys)} merchants: {self.dm_subscription_id}...")
-            await self.ws.send(json.dumps(['REQ', self.dm_subscription_id, {"#p": list(self.subscribed_merchant_pubkeys), 'kinds': [EventKind.DM]}]))
-            return self.dm_subscription_id
+        return await self.subscribe_dm_all([pubkey])
 
     async def subscribe_dm_all(self, pubkeys):
-        if self.dm_subscription_id is not None:
-            logging.info(f"({self.url}) Closing subscription for DMs of {len(self.subscribed_merchant_pubkeys)} merchants: {self.dm_subscription_id}...")
-            await self.ws.send(json.dumps(['CLOSE', self.dm_subscription_id]))
-        self.subscribed_merchant_pubkeys |= set(pubkeys)
-        self.dm_subscription_id = os.urandom(10).hex()
-        logging.info(f"({self.url}) Subscribing to DMs of {len(self.subscribed_merchant_pubkeys)} merchants: {self.dm_subscription_id}...")
-        await self.ws.send(json.dumps(['REQ', self.dm_subscription_id, {"#p": list(self.subscribed_merchant_pubkeys), 'kinds': [EventKind.DM]}]))
-        return self.dm_subscription_id
+        new_pubkeys = set(pubkeys) - self.subscribed_merchant_pubkeys
+        if new_pubkeys:
+            self.subscribed_merchant_pubkeys |= new_pubkeys
+            logging.info(f"({self.url}) Subscribing to DMs of {len(new_pubkeys)} more merchants (out of {len(self.subscribed_merchant_pubkeys)})...")
+            for shard in {get_shard(pubkey) for pubkey in new_pubkeys}:
+                for kind in self.get_merchant_event_kinds():
+                    await self.subscribe_shard(kind, shard, new_pubkeys)
 
     async def subscribe_bids(self, pubkey, id, **_):
         if id not in self.subscribed_auction_event_ids:
-            if self.bid_subscription_id is not None:
-                logging.info(f"({self.url}) Closing subscription for bids of {len(self.subscribed_auction_event_ids)} auctions: {self.bid_subscription_id}...")
-                await self.ws.send(json.dumps(['CLOSE', self.bid_subscription_id]))
             self.subscribed_auction_event_ids.add(id)
-            assert id not in self.auction_owners
             self.auction_owners[id] = pubkey
-            self.bid_subscription_id = os.urandom(10).hex()
-            logging.info(f"({self.url}) Subscribing to bids of {len(self.subscribed_auction_event_ids)} auctions: {self.bid_subscription_id}...")
-            await self.ws.send(json.dumps(['REQ', self.bid_subscription_id, {"#e": list(self.subscribed_auction_event_ids), 'kinds': [EventKind.BID]}]))
-            return self.bid_subscription_id
-
-    async def send_event(self, event):
-        if self.ws is not None:
+            logging.info(f"({self.url}) Subscribing to bids of one more auction (out of {len(self.subscribed_auction_event_ids)})...")
+            await self.subscribe_shard(EventKind.BID, get_shard(id), {id})
+
+    async def unsubscribe_bids(self, auction_event_ids):
+        auction_event_ids = auction_event_ids & self.subscribed_auction_event_ids
+        if not auction_event_ids:
+            return
+        self.subscribed_auction_event_ids -= auction_event_ids
+        for id in auction_event_ids:
+            self.auction_owners.pop(id, None)
+        if self.ws is None:
+            return # NB: we will resubscribe when we reconnect anyway
+        for shard in {get_shard(id) for id in auction_event_ids}:
+            await self.subscribe_shard(EventKind.BID, shard)
+
+    async def resubscribe(self):
+        # after (re)connecting, we subscribe to everything again, starting where we left off
+        self.subscription_ids = {}
+        self.full_subscriptions = {}
+        if self.args.discover and self.args.discover_all:
+            await self.subscribe_auction()
+            await self.subscribe_stall()
+        logging.info(f"({self.url}) Subscribing to DMs of {len(self.subscribed_merchant_pubkeys)} merchants and bids of {len(self.subscribed_auction_event_ids)} auctions...")
+        for shard in {get_shard(pubkey) for pubkey in self.subscribed_merchant_pubkeys}:
+            for kind in self.get_merchant_event_kinds():
+                await self.subscribe_shard(kind, shard)
+        for shard in {get_shard(id) for id in self.subscribed_auction_event_ids}:
+            await self.subscribe_shard(EventKind.BID, shard)
+
+    async def send_event(self, event, timeout):
+        # sends the event and waits for the relay to acknowledge it (NIP-20)
+        if self.ws is None:
+            return 'not_connected'
+        ok = self.pending_oks.get(event['id'])
+        if ok is None: # NB: otherwise the same event is already being sent, so we just wait for the same OK
+            ok = self.pending_oks[event['id']] = asyncio.get_running_loop().create_future()
             logging.info(f"({self.url}) Sending event {event['id']}...")
-            await self.ws.send(json.dumps(['EVENT', event]))
+            try:
+                await self.ws.send(json.dumps(['EVENT', event]))
+            except Exception:
+                del self.pending_oks[event['id']]
+                raise
+        try:
+            accepted, message = await asyncio.wait_for(asyncio.shield(ok), timeout)
+        except asyncio.TimeoutError:
+            if self.pending_oks.get(event['id']) is ok:
+                del self.pending_oks[event['id']]
+            logging.warning(f"({self.url}) No OK for event {event['id']}!")
+            return 'timeout'
+        if not accepted:
+            logging.warning(f"({self.url}) Event {event['id']} rejected: {message}!")
+            return 'rejected'
+        return 'ok'
 
     async def send_query(self, subscription_id: str, filters: dict):
-        if self.ws is not None:
-            logging.info(f"({self.url}) Sending query {filters}...")
-            self.active_queries[subscription_id] = asyncio.Event()
-            self.query_results[subscription_id] = []
-            await self.ws.send(json.dumps(['REQ', subscription_id, filters]))
+        if self.ws is None:
+            return False
+        logging.info(f"({self.url}) Sending query {filters}...")
+        self.active_queries[subscription_id] = asyncio.Event()
+        self.query_results[subscription_id] = []
+        self.query_started_at[subscription_id] = asyncio.get_running_loop().time()
+        await self.ws.send(json.dumps(['REQ', subscription_id, filters]))
+        return True
+
+    def record_query_latency(self, latency):
+        self.query_latency = latency if self.query_latency is None else 0.8 * self.query_latency + 0.2 * latency
+
+    def record_event_lag(self, lag):
+        self.event_lag = lag if self.event_lag is None else 0.8 * self.event_lag + 0.2 * lag
+
+    async def end_query(self, subscription_id: str):
+        # called once we are not interested in the results anymore. if the relay did not finish answering by now, it counts as a miss
+        if subscription_id in self.query_started_at:
+            del self.query_started_at[subscription_id]
+            logging.warning(f"({self.url}) Did not finish the reply for {subscription_id} on time!")
+            self.record_query_latency(2 * QUERY_TIMEOUT)
+            if self.ws is not None:
+                try:
+                    await self.ws.send(json.dumps(['CLOSE', subscription_id]))
+                except Exception:
+                    logging.exception(f"({self.url}) Error closing subscription {subscription_id}.")
+        self.active_queries.pop(subscription_id, None)
+        self.query_results.pop(subscription_id, None)
 
     async def process_event(self, event):
         match event['kind']:
@@ -223,28 +695,12 @@ class Relay:
                     auction = None
 
                 if isinstance(auction, dict) and 'start_date' in auction and auction['start_date'] and 'duration' in auction and auction['duration']:
-                    if datetime.fromtimestamp(auction['start_date']) + timedelta(seconds=auction['duration']) > datetime.utcnow():
-                        await self.check_ours(event, self.subscribe_bids)
+                    end_date = datetime.fromtimestamp(auction['start_date']) + timedelta(seconds=auction['duration'])
+                    if end_date > datetime.utcnow():
+                        await self.check_ours(event, lambda **event: self.dispatcher.subscribe_bids(end_date=end_date, **event))
             case EventKind.STALL:
-                await self.check_ours(event, self.subscribe_dm)
-            case EventKind.DM:
-                merchant_pubkey = [t for t in event['tags'] if t[0] == 'p'][0][1]
-                logging.info(f"({self.url}) POSTing DM event to API: {event['id']}")
-                post_status = await self.post_dm(merchant_pubkey, event)
-                if post_status not in RECOVERABLE_API_ERROR_STATI:
-                    self.processed_event_ids.add(event['id'])
-                    if PROCESSED_EVENT_IDS_FILENAME:
-                        async with async_open(PROCESSED_EVENT_IDS_FILENAME, 'a') as f:
-                            await f.write(f"{event['id']}\n")
-            case EventKind.BID:
-                auction_event_id = [t for t in event['tags'] if t[0] == 'e'][0][1]
-                logging.info(f"({self.url}) POSTing bid event to API: {event['id']}")
-                post_status = await self.post_bid(auction_event_id, event)
-                if post_status not in RECOVERABLE_API_ERROR_STATI:
-                    self.processed_event_ids.add(event['id'])
-                    if PROCESSED_EVENT_IDS_FILENAME:
-                        async with async_open(PROCESSED_EVENT_IDS_FILENAME, 'a') as f:
-                            await f.write(f"{event['id']}\n")
+                await self.check_ours(event, self.dispatcher.subscribe_dm)
+            # NB: DMs and bids are forwarded to the API in batches (see EventDispatcher.forward_events)
 
     async def listen(self):
         while True:
@@ -258,14 +714,15 @@ class Relay:
 
             try:
                 if self.args.merchant:
-                    await self.subscribe_dm(self.args.merchant)
+                    self.subscribed_merchant_pubkeys.add(self.args.merchant)
                     if self.args.auction:
-                        await self.subscribe_bids(self.args.merchant, self.args.auction)
-                else:
-                    await self.get_our_merchants(self.subscribe_dm_all)
-                if self.args.discover:
-                    await self.subscribe_auction()
-                    await self.subscribe_stall()
+                        self.subscribed_auction_event_ids.add(self.args.auction)
+                        self.auction_owners[self.args.auction] = self.args.merchant
+                # NB: our merchants (see EventDispatcher.watch_merchants) and the merchants and auctions other relays discovered before we connected
+                self.subscribed_merchant_pubkeys |= self.dispatcher.merchant_pubkeys
+                self.subscribed_auction_event_ids |= self.dispatcher.auction_owners.keys()
+                self.auction_owners.update(self.dispatcher.auction_owners)
+                await self.resubscribe()
             except Exception:
                 logging.exception(f"({self.url}) Cannot subscribe.")
                 return
@@ -277,12 +734,23 @@ class Relay:
                     match message[0]:
                         case 'NOTICE':
                             logging.info(f"({self.url}) NOTICE {message[1]}...")
+                        case 'OK':
+                            ok = self.pending_oks.pop(message[1], None)
+                            if ok is not None and not ok.done():
+                                ok.set_result((message[2], message[3] if len(message) > 3 else ""))
                         case 'EOSE':
                             subscription_id = message[1]
                             if subscription_id in self.active_queries:
                                 logging.info(f"({self.url}) Closing subscription {subscription_id}...")
                                 await self.ws.send(json.dumps(['CLOSE', subscription_id]))
+                                self.record_query_latency(asyncio.get_running_loop().time() - self.query_started_at.pop(subscription_id))
                                 self.active_queries[subscription_id].set()
+                            elif subscription_id in self.full_subscriptions:
+                                kind, started_at = self.full_subscriptions.pop(subscription_id)
+                                # NB: we are only up to date once *all* the subscriptions (shards) for this kind of events reached EOSE
+                                # (and the cursor we save is still held back by the events of these subscriptions that we did not process yet)
+                                if all(k != kind for k, _ in self.full_subscriptions.values()):
+                                    self.advance_cursor(kind, started_at)
                         case 'EVENT':
                             subscription_id = message[1]
                             event = message[2]
@@ -290,30 +758,29 @@ class Relay:
                                 logging.info(f"({self.url}) Got EVENT as a reply for query {subscription_id}.")
                                 self.query_results[subscription_id].append(event)
                             else:
-                                logging.info(f"({self.url}) Got EVENT {event}. Adding to queue...")
-                                self.events_to_process.put_nowait(event)
+                                if event['kind'] in CURSOR_EVENT_KINDS:
+                                    # NB: events claiming to be from the future don't move us forward, otherwise we could miss events when resubscribing
+                                    self.advance_cursor(event['kind'], min(event['created_at'], int(time.time())))
+                                await self.dispatcher.dispatch(self, event)
             except Exception:
                 self.ws = None
                 logging.exception(f"({self.url}) Connection closed.")
                 await asyncio.sleep(10)
 
-    async def process_events(self):
-        while True:
-            if self.events_to_process.empty():
-                await asyncio.sleep(0.1)
-                continue
-            event = await self.events_to_process.get()
-            if event['id'] in self.event_ids_being_processed:
-                logging.info(f"({self.url}) Skipping event currently being processed: {event['id']}!")
-            elif event['id'] in self.processed_event_ids:
-                logging.info(f"({self.url}) Skipping event already processed: {event['id']}!")
-            else:
-                logging.info(f"({self.url}) Processing event {event['id']}...")
-                self.event_ids_being_processed.add(event['id'])
-                try:
-                    await asyncio.create_task(self.process_event(event))
-                finally:
-                    self.event_ids_being_processed.remove(event['id'])
+def log_forward_result(forward, result):
+    status, message = result['status'], result.get('message')
+    if 'auction_event_id' in forward:
+        target = f"auction {forward['auction_event_id']} of merchant {forward['merchant_public_key']}"
+    else:
+        target = f"merchant {forward['merchant_public_key']}"
+    if status == 200:
+        logging.info(f"Forwarded {forward['event']['id']} to {target}.")
+    elif status == 409:
+        logging.info(f"Not forwarded {forward['event']['id']} to {target}: {message}")
+    elif status in PERMANENT_API_ERROR_STATI or status in RECOVERABLE_API_ERROR_STATI:
+        logging.error(f"Error posting {forward['event']['id']} to {target}: {status}; {message=}.")
+    else:
+        logging.error(f"Unknown status when posting {forward['event']['id']} to {target}: {status}.")
 
 async def get_url_aiohttp(url):
     async with aiohttp.ClientSession() as session:
@@ -371,10 +838,20 @@ async def verify_external_identity(pk, external_identity, proof):
     return pk, external_identity, verifier(response_url, response_text, pk2npub(pk), claimed_id)
 
 async def main(relays: list[Relay]):
-    all_tasks = []
+    all_tasks = [asyncio.create_task(processed_event_ids.maintain()), asyncio.create_task(dispatcher.evict_ended_auctions()), asyncio.create_task(dispatcher.save_cursors()), asyncio.create_task(dispatcher.retry_events())]
+    if not args.merchant:
+        all_tasks.append(asyncio.create_task(dispatcher.watch_merchants()))
+    for queue in dispatcher.queues:
+        all_tasks.append(asyncio.create_task(dispatcher.process_events(queue)))
     for relay in relays:
         all_tasks.append(asyncio.create_task(relay.listen()))
-        all_tasks.append(asyncio.create_task(relay.process_events()))
+
+    background_tasks = set()
+
+    def run_in_background(coro):
+        task = asyncio.create_task(coro)
+        background_tasks.add(task) # NB: keep a reference to the task, so it doesn't get garbage collected before it's done
+        task.add_done_callback(background_tasks.discard)
 
     app = web.Application()
     routes = web.RouteTableDef()
@@ -393,21 +870,148 @@ async def main(relays: list[Relay]):
 
     @routes.get("/status")
     async def get_status(request):
-        return web.json_response({'running': True})
+        return web.json_response({
+            'running': True,
+            'queued_events': sum(queue.qsize() for queue in dispatcher.queues),
+            'unprocessed_events': len(dispatcher.unprocessed),
+            'retrying_events': len(dispatcher.retries),
+            'subscribed_merchants': len(dispatcher.merchant_pubkeys),
+            'subscribed_auctions': len(dispatcher.auction_owners),
+            'relays': [{
+                'url': relay.url,
+                'connected': relay.ws is not None,
+                'subscribed_merchants': len(relay.subscribed_merchant_pubkeys),
+                'subscribed_auctions': len(relay.subscribed_auction_event_ids),
+                'subscriptions': dict(Counter(kind.name for kind, _ in relay.subscription_ids)),
+                'query_latency': relay.query_latency,
+                'first_seen_count': relay.first_seen_count,
+                'event_lag': relay.event_lag,
+            } for relay in relays],
+        })
+
+    async def forward_event(event_json):
+        async def send_event(relay):
+            try:
+                return await relay.send_event(event_json, PUBLISH_TIMEOUT)
+            except ConnectionClosedOK:
+                relay.ws = None
+                logging.error(f"Lost connection while trying to forward event {event_json['id']} to {relay.url}!")
+            except Exception:
+                logging.exception(f"Error forwarding event {event_json['id']} to {relay.url}!")
+            return 'error'
+
+        logging.info(f"Forwarding event to all relays: {event_json['id']}!")
+        if event_json['kind'] == EventKind.BID_STATUS:
+            dispatcher.track_bid_status(event_json)
+        # NB: we don't want to keep serving cached query results that don't include the event we just published
+        for key in [key for key, (filters, _, _) in query_cache.items() if matches_filters(event_json, filters)]:
+            del query_cache[key]
+        current_relays = list(relays)
+        quorum = min(PUBLISH_QUORUM, len(current_relays))
+        results = {relay.url: 'pending' for relay in current_relays}
+        tasks = {asyncio.create_task(send_event(relay)): relay for relay in current_relays}
+        ok_count = 0
+        deadline = asyncio.get_running_loop().time() + PUBLISH_TIMEOUT
+        pending = set(tasks)
+        while pending and ok_count < quorum:
+            # NB: we return as soon as we have the quorum - the other relays will still get the event, we just don't wait for them
+            done, pending = await asyncio.wait(pending, timeout=deadline - asyncio.get_running_loop().time(), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                results[tasks[task].url] = task.result()
+                if task.result() == 'ok':
+                    ok_count += 1
+
+        quorum_reached = ok_count > 0 and ok_count >= quorum
+        if not quorum_reached:
+            logging.warning(f"Event {event_json['id']} acknowledged by {ok_count} relays, which is not enough: {results}!")
+        return {'relays': results, 'quorum_reached': quorum_reached}
 
     @routes.post("/events")
     async def post_event(request):
         event_json = await request.json()
-        logging.info(f"Forwarding event to all relays: {event_json['id']}!")
-        for relay in relays:
+        return web.json_response(await forward_event(event_json))
+
+    @routes.post("/events/batch")
+    async def post_events(request):
+        events_json = (await request.json())['events']
+        logging.info(f"Forwarding a batch of {len(events_json)} events to all relays!")
+        results = await asyncio.gather(*[forward_event(event_json) for event_json in events_json])
+        # NB: results are returned as a list (rather than a dict by event ID), in the same order as the events in the request
+        return web.json_response({'events': [{'id': event_json['id'], **result} for event_json, result in zip(events_json, results)]})
+
+    async def run_query(filters):
+        subscription_id = os.urandom(10).hex()
+
+        connected_relays = sorted([relay for relay in relays if relay.ws is not None], key=lambda relay: relay.query_latency or 0)
+        query_relays = connected_relays[:QUERY_FANOUT]
+        if len(connected_relays) > QUERY_FANOUT:
+            query_relays.append(random.choice(connected_relays[QUERY_FANOUT:]))
+
+        async def send_query(relay):
             try:
-                await relay.send_event(event_json)
+                return await relay.send_query(subscription_id, filters)
             except ConnectionClosedOK:
                 relay.ws = None
-                logging.error(f"Lost connection while trying to forward event {event_json['id']} to {relay.url}!")
+                logging.error(f"Lost connection while trying to query {relay.url}!")
             except Exception:
-                logging.exception(f"Error forwarding event {event_json['id']} to {relay.url}!")
-        return web.json_response({})
+                logging.exception(f"Error sending query to {relay.url}!")
+            return False
+
+        sent = await asyncio.gather(*[send_query(relay) for relay in query_relays])
+        query_relays = [relay for relay, relay_sent in zip(query_relays, sent) if relay_sent]
+
+        deadline = asyncio.get_running_loop().time() + QUERY_TIMEOUT
+        quorum = min(QUERY_QUORUM, len(query_relays))
+        pending = {asyncio.create_task(relay.active_queries[subscription_id].wait()) for relay in query_relays}
+        while pending and len(query_relays) - len(pending) < quorum:
+            done, pending = await asyncio.wait(pending, timeout=deadline - asyncio.get_running_loop().time(), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+
+        query_results = {}
+        for relay in query_relays:
+            logging.info(f"Got {len(relay.query_results[subscription_id])} results from {relay.url}!")
+            for event in relay.query_results[subscription_id]:
+                query_results[event['id']] = event # NB: if we get the same event from multiple relays, we only store it once!
+
+        async def end_query():
+            # NB: we don't wait for the slower relays, but we still give them until the deadline to answer, so we know how slow they are
+            if pending:
+                await asyncio.wait(pending, timeout=max(deadline - asyncio.get_running_loop().time(), 0))
+            for task in pending:
+                task.cancel()
+            for relay in query_relays:
+                await relay.end_query(subscription_id)
+        run_in_background(end_query())
+
+        return query_results
+
+    query_cache: OrderedDict[str, tuple[dict, float, dict]] = OrderedDict() # key => (filters, expires at, results)
+    queries_in_flight: dict[str, asyncio.Task] = {}
+
+    async def query_relays_cached(filters):
+        key = json.dumps(filters, sort_keys=True)
+        now = asyncio.get_running_loop().time()
+        while query_cache and (next(iter(query_cache.values()))[1] <= now or len(query_cache) > QUERY_CACHE_MAX_ENTRIES):
+            query_cache.popitem(last=False) # NB: all entries have the same TTL, so the oldest ones expire first
+        if key in query_cache:
+            logging.info(f"Cached query results for {filters}.")
+            return query_cache[key][2]
+
+        if key not in queries_in_flight:
+            def cache_results(task):
+                del queries_in_flight[key]
+                if not task.cancelled() and task.exception() is None:
+                    query_cache[key] = (filters, asyncio.get_running_loop().time() + QUERY_CACHE_TTL, task.result())
+            task = queries_in_flight[key] = asyncio.create_task(run_query(filters))
+            task.add_done_callback(cache_results)
+        else:
+            logging.info(f"Waiting for the same query already in flight for {filters}.")
+
+        # NB: shield the shared query, so it doesn't get cancelled if one of the requests waiting for it does
+        return await asyncio.shield(queries_in_flight[key])
 
     @routes.post("/query")
     async def query(request):
@@ -420,42 +1024,7 @@ async def main(relays: list[Relay]):
         if filters is None:
             raise web.HTTPBadRequest()
 
-        subscription_id = os.urandom(10).hex()
-
-        async def send_query():
-            for relay in relays:
-                try:
-                    await relay.send_query(subscription_id, filters)
-                except ConnectionClosedOK:
-                    relay.ws = None
-                    logging.error(f"Lost connection while trying to query {relay.url}!")
-                except Exception:
-                    logging.exception(f"Error sending query to {relay.url}!")
-
-        async def collect_query_results():
-            query_results = {}
-            for relay in relays:
-                if subscription_id in relay.active_queries:
-                    try:
-                        await asyncio.wait_for(relay.active_queries[subscription_id].wait(), timeout=1.0)
-                    except asyncio.TimeoutError:
-                        logging.error(f"Relay {relay.url} did not finish the reply for {subscription_id} on time!")
-
-                    logging.info(f"Got {len(relay.query_results[subscription_id])} results from {relay.url}!")
-
-                    for event in relay.query_results[subscription_id]:
-                        query_results[event['id']] = event # NB: if we get the same event from multiple relays, we only store it once!
-                    del relay.active_queries[subscription_id]
-                    del relay.query_results[subscription_id]
-            return query_results
-
-        await asyncio.create_task(send_query())
-
-        await asyncio.sleep(0.1) # give the query a chance to execute!
-
-        query_results_task = asyncio.create_task(collect_query_results())
-        await query_results_task
-        query_results = query_results_task.result()
+        query_results = await query_relays_cached(filters)
 
         # NB: for "metadata" events, we also validate the external identities here...
 
@@ -499,10 +1068,9 @@ async def main(relays: list[Relay]):
         relay_json = await request.json()
         logging.info(f"Adding new relay: {relay_json['url']}!")
         try:
-            relay = Relay(relay_json['url'], args, processed_event_ids, event_ids_being_processed)
+            relay = Relay(relay_json['url'], args, dispatcher)
             relays.append(relay)
             all_tasks.append(asyncio.create_task(relay.listen()))
-            all_tasks.append(asyncio.create_task(relay.process_events()))
             return web.json_response({})
         except Exception:
             logging.exception(f"Error adding relay: {relay['url']}!")
@@ -521,29 +1089,28 @@ parser = argparse.ArgumentParser(
 parser.add_argument("-r", "--relay", help="relay to connect to")
 parser.add_argument("--discover", default=True, help="discover stalls and auctions", action=argparse.BooleanOptionalAction)
 parser.parse_args(["--no-discover"])
+parser.add_argument("--discover-all", default=False, help="discover the stalls and auctions of all merchants on the relays, not only of our merchants", action=argparse.BooleanOptionalAction)
 parser.add_argument("-m", "--merchant", help="pubkey of the merchant to listen to events for")
 parser.add_argument("-a", "--auction", help="event ID of the auction to listen to bids for (NB: we assume the auction belongs to the specified merchant)")
 
 args = parser.parse_args()
 
-processed_event_ids = set()
-event_ids_being_processed = set()
+processed_event_ids = ProcessedEventStore(PROCESSED_EVENTS_DB_FILENAME)
 
-if PROCESSED_EVENT_IDS_FILENAME:
-    if os.path.isfile(PROCESSED_EVENT_IDS_FILENAME):
-        with open(PROCESSED_EVENT_IDS_FILENAME, 'r') as f:
-            for line in f:
-                processed_event_ids.add(line.strip())
-    logging.info(f"Processed events: {len(processed_event_ids)}")
+if PROCESSED_EVENTS_DB_FILENAME:
+    if PROCESSED_EVENT_IDS_FILENAME and os.path.isfile(PROCESSED_EVENT_IDS_FILENAME):
+        logging.info(f"Imported processed events from {PROCESSED_EVENT_IDS_FILENAME}: {processed_event_ids.import_file(PROCESSED_EVENT_IDS_FILENAME)}")
+        os.rename(PROCESSED_EVENT_IDS_FILENAME, f"{PROCESSED_EVENT_IDS_FILENAME}.imported")
 else:
     logging.warning("Processed event IDs will not be persisted!")
 
 logging.warning("No API_BASE_URL to connect to!")
 
 relays: list[Relay] = []
+dispatcher = EventDispatcher(relays, processed_event_ids)
 
 if args.relay:
-    relays.append(Relay(args.relay, args, processed_event_ids, event_ids_being_processed))
+    relays.append(Relay(args.relay, args, dispatcher))
 else:
     if API_BASE_URL:
         while True:
@@ -551,7 +1118,7 @@ else:
             try:
                 response = requests.get(f"{API_BASE_URL}/api/relays").json()
                 for relay in response['relays']:
-                    relays.append(Relay(relay['url'], args, processed_event_ids, event_ids_being_processed))
+                    relays.append(Relay(relay['url'], args, dispatcher))
                 logging.info(f"Got {len(response['relays'])} relays!")
                 break
             except Exception:
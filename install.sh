@@ -74,6 +74,7 @@ BIRDWATCHER_BASE_URL=http://birdwatcher:6000
 LNDHUB_URL=https://ln.getalby.com
 LOG_FILENAME=/state/pm.log
 PROCESSED_EVENT_IDS_FILENAME=/state/processed_event_ids.txt
+PROCESSED_EVENTS_DB_FILENAME=/state/processed_events.sqlite
 VERIFIED_EXTERNAL_IDENTITIES_FILENAME=/state/verified_external_identities.txt
 GECKODRIVER_BINARY=/app/geckodriver
 USER_EMAIL_VERIFICATION=0
@@ -253,6 +254,18 @@ services:
       - "./plebeian-market-state:/state"
     env_file: .env
     command: flask settle-btc-payments
+  drain-outbox:
+    image: ghcr.io/plebeiantech/plebeian-market-api
+    depends_on: [db, birdwatcher]
+    restart: always
+    stop_grace_period: 30s
+    networks:
+      - db_network
+    volumes:
+      - "./plebeian-market-secrets:/secrets"
+      - "./plebeian-market-state:/state"
+    env_file: .env
+    command: flask drain-outbox
   birdwatcher:
     image: ghcr.io/plebeiantech/plebeian-market-birdwatcher
     restart: always